@@ -21,57 +21,158 @@
 import os
 import math
 import thread
-import Queue
-import urllib
 import logging
+import cStringIO
 import wx
 import wx.lib.newevent
 #from wx.lib.buttons import GenBitmapButton, GenBitmapToggleButton
-from PIL import Image
-from threading import Timer
+from optparse import OptionParser
+from collections import OrderedDict
 from xml.dom.minidom import Document
 
-import globalmaptiles
+import downloader
+import geometry
+import clustering
+import tilestore
+import kmlparser
+import prefetcher
 import marker_dialog
 import path_dialog
+from projection import mercator, tolist
 
 logging.basicConfig(filename='debug.log',
         format='%(levelname)s:%(threadName)s:%(funcName)s: %(message)s',
         level=logging.DEBUG)
 
-baseurlmap = {0: "http://mt1.google.com/vt/lyrs=m@132&hl=en",  # default
-    1: "http://mt1.google.com/vt/lyrs=t",
-    2: "http://mt1.google.com/vt/lyrs=p",
+APP_NAME = "Application"
+MAP_TYPE = 0  # tipo iniziale, tra 0 e 4, vedi downloader.baseurlmap
+CACHE_BACKEND = "files"  # "files" (un file per tile) oppure "mbtiles"
+DIR_CACHE = os.getcwd() + "/cache/"  # una cache per ogni tipo di mappa
+CACHE_QUOTA = 0  # byte massimi della cache su disco, 0 per nessun limite
+CACHE_MAX_AGE = 0  # secondi dopo cui una tile e' riscaricata, 0 per mai
+DOWNLOAD_ENGINE = "threads"  # "threads" oppure "async" (un solo thread)
+DOWNLOAD_THREAD_NUM = 3
+QUEUE_WAIT = 0.5
+OVERLAYS = []  # overlay mostrati all'avvio sopra la mappa, es. [5]
+BITMAP_CACHE_SIZE = 64 * 1024 * 1024  # byte di bitmap decodificate in memoria
+TILE_KEEP_MARGIN = 4  # tile tenute in memoria oltre l'area visibile
+PLACEHOLDER_LEVELS = 4  # livelli di zoom in cui cercare una tile da ingrandire
+PREFETCH_RATE = 8  # tile al secondo scaricate in anticipo, 0 per nessuna
+PREDECODE_PER_IDLE = 4  # tile in cache decodificate in anticipo per idle
+VECTOR_MARGIN = 256  # pixel oltre la finestra in cui disegnare marker e path
+VECTOR_KEEP_MARGIN = 2048  # pixel oltre la finestra in cui tenerli disegnati
+HIT_TOLERANCE = 4  # pixel di distanza entro cui un click prende un percorso
+SIMPLIFY_TOLERANCE = 0.5  # pixel di scarto dei vertici omessi dai percorsi
+CLUSTER_RADIUS = 12  # raggio minimo in pixel del simbolo dei gruppi di marker
+
+
+#coda delle tile da scaricare: vengono scaricate prima quelle vicine al centro
+#della finestra, quelle di un altro livello di zoom o uscite dalla finestra
+#vengono scartate; quelle scaricate in anticipo dal prefetch passano solo se
+#non ce ne sono di visibili, al massimo PREFETCH_RATE al secondo
+tile_to_download = downloader.TileScheduler(
+        limiter=downloader.RateLimiter(PREFETCH_RATE))
+
+#tile il cui download e' fallito: non vengono richieste di nuovo fino a quando
+#non scade la loro attesa
+failed_tiles = downloader.NegativeCache()
+
+
+class BitmapCache:
+    """
+    LRU cache of decoded tile bitmaps, bounded by an approximate byte budget.
+    It survives zoom changes, so a tile decoded once is not decoded again
+    while it stays in the cache.
+    """
 
-    # mappe satellitari
-    3: "http://mt1.google.com/vt/lyrs=s",
+    def __init__(self, maxbytes=BITMAP_CACHE_SIZE):
+        """
+        Args:
+            maxbytes (int): memory budget for the cached bitmaps
+        """
+        self.maxbytes = maxbytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
 
-    # mappe satellitari con strade
-    4: "http://mt1.google.com/vt/lyrs=y",
+    def __len__(self):
+        return len(self._items)
 
-    # overlay:
-    5: "http://mt1.google.com/vt/lyrs=h",
-    6: "http://mt1.google.com/vt/lyrs=r"
-}
+    def __contains__(self, key):
+        # non conta come accesso, non cambia l'ordine
+        return key in self._items
+
+    def get(self, key):
+        """
+        Returns:
+            wx.Bitmap.  the cached bitmap, or None
+        """
+        try:
+            bmp, size = self._items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        # reinserisco in coda: e' il piu' recente
+        self._items[key] = (bmp, size)
+        self.hits += 1
+        return bmp
+
+    def put(self, key, bmp):
+        self.discard(key)
+        size = bmp.GetWidth() * bmp.GetHeight() * 4
+        if size > self.maxbytes:
+            return
+        self._items[key] = (bmp, size)
+        self.bytes += size
+        while self.bytes > self.maxbytes:
+            _, (_, oldsize) = self._items.popitem(last=False)
+            self.bytes -= oldsize
+            self.evictions += 1
+
+    def discard(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.bytes -= item[1]
+
+    def clear(self):
+        self._items.clear()
+        self.bytes = 0
+
+    def stats(self):
+        """
+        Returns:
+            dict.  counters used to size BITMAP_CACHE_SIZE
+        """
+        return {"items": len(self._items), "bytes": self.bytes,
+                "maxbytes": self.maxbytes, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
 
-APP_NAME = "Application"
-MAP_TYPE = 0  # numero tra 0 e 6
-DIR_CACHE = os.getcwd() + "/cache/" + str(MAP_TYPE) + "/"
-DOWNLOAD_THREAD_NUM = 3
-QUEUE_WAIT = 0.5
 
+def composite(base, overlays):
+    """
+    draws the overlays, with their transparency, on a copy of base
 
-#coda di tipo LIFO: se cambio livello di zoom vengono inseriti nella coda tile
-#relativi al nuovo livello di zoom, voglio che vengano mostrati prima questi
-tile_to_download = Queue.LifoQueue(maxsize=0)
+    Returns:
+        wx.Bitmap.  the composite tile
+    """
+    bitmap = base.GetSubBitmap(wx.Rect(0, 0, base.GetWidth(),
+            base.GetHeight()))
+    dc = wx.MemoryDC(bitmap)
+    for overlay in overlays:
+        dc.DrawBitmap(overlay, 0, 0, True)
+    dc.SelectObject(wx.NullBitmap)
+    return bitmap
 
 
 class Tile:
     """
-    A tile is a 255*255 pixels png image
+    A tile is a 255*255 pixels png image, of a base map with optionally some
+    overlays drawn on it
     """
 
-    def __init__(self, x, y, zoom):
+    def __init__(self, x, y, zoom, map_type=0, overlays=()):
         """
         Tile constructior.
 
@@ -79,52 +180,157 @@ class Tile:
             x (int): x coordinate for this tile
             y (int): y coordinate for this tile
             zoom (int): zoom for this tile
+            map_type (int): key of downloader.baseurlmap
+            overlays (list): map types drawn over map_type
         """
         self.tile = x, y, zoom
+        self.map_type = map_type
+        self.layers = (map_type,) + tuple(overlays)
+        # chiave della bitmap composta, per una sola mappa e' anche la
+        # chiave del download
+        self.key = self.tile + self.layers
+        self.missing = []
         self.id = wx.NewId()
 
-    def loadtile(self):
+    def loadlayer(self, frame, map_type, tile=None):
+        """
+        decodes a layer of this tile, if it is in the cache
+
+        Args:
+            tile (tuple): (x, y, zoom) of another tile to decode instead
+
+        Returns:
+            wx.Bitmap.  the layer, None if it is not downloaded yet
         """
-        loads the image representing this tile (if already downloaded)
+        tile = tile or self.tile
+        key = tile + (map_type,)
+        bitmap = frame.bitmaps.get(key)
+        store = frame.get_store(map_type)
+        if bitmap is not None:
+            # usata senza leggerla dal disco: la cache non deve eliminarla
+            store.touch(*tile)
+        else:
+            # le tile vengono controllate e scritte in modo atomico da
+            # savetile, se c'e' e' completa
+            img = store.get(*tile)
+            if img is not None:
+                image = wx.ImageFromStream(cStringIO.StringIO(img),
+                        wx.BITMAP_TYPE_ANY)
+                if image.IsOk():
+                    bitmap = image.ConvertToBitmap()
+                    frame.bitmaps.put(key, bitmap)
+                else:
+                    # tile rovinata (cache scritta da vecchie versioni):
+                    # la elimino, cosi' viene scaricata di nuovo
+                    logging.error("invalid tile %s", str(key))
+                    store.delete(*tile)
+        return bitmap
+
+    def placeholder(self, frame):
+        """
+        makes a temporary image for this tile while it is downloaded,
+        enlarging its part of the nearest ancestor in the cache or, after a
+        zoom out, reducing its children. The image stays in frame.bitmaps
+        until the tile arrives.
 
         Returns:
-            str.  image path
+            wx.Bitmap.  the placeholder, None if nothing is in the cache
         """
+        key = ("placeholder",) + self.key
+        bitmap = frame.bitmaps.get(key)
+        if bitmap is not None:
+            return bitmap
         x, y, zoom = self.tile
-        filename = DIR_CACHE + "/" + str(x) + "-" + str(y) + "-" + \
-                        str(zoom) + ".png"
-        if (os.path.exists(filename)):
-            try:
-                img = Image.open(filename)
-                cond = img.verify()
-                return [filename, ]
-
-            except IOError as detail:
-                logging.error("error: %s", detail)
-                return None
+        for d in range(1, min(PLACEHOLDER_LEVELS, zoom) + 1):
+            parent = (x >> d, y >> d, zoom - d)
+            image = frame.bitmaps.get(parent + self.layers)
+            if image is None:
+                image = self.loadlayer(frame, self.map_type, parent)
+            if image is not None:
+                size = 256 >> d
+                part = image.GetSubBitmap(wx.Rect((x % 2 ** d) * size,
+                        (y % 2 ** d) * size, size, size))
+                bitmap = part.ConvertToImage().Scale(256, 256) \
+                        .ConvertToBitmap()
+                break
         else:
-            return None
+            bitmap = self.children(frame)
+        if bitmap is not None:
+            frame.bitmaps.put(key, bitmap)
+        return bitmap
+
+    def children(self, frame):
+        """
+        Returns:
+            wx.Bitmap.  the children of this tile in the cache, reduced
+            and put together, None if there are none
+        """
+        x, y, zoom = self.tile
+        bitmap = None
+        for cx in (0, 1):
+            for cy in (0, 1):
+                child = (2 * x + cx, 2 * y + cy, zoom + 1)
+                image = frame.bitmaps.get(child + self.layers)
+                if image is None:
+                    image = self.loadlayer(frame, self.map_type, child)
+                if image is None:
+                    continue
+                if bitmap is None:
+                    bitmap = wx.EmptyBitmap(256, 256)
+                    dc = wx.MemoryDC(bitmap)
+                    dc.Clear()
+                small = image.ConvertToImage().Scale(128, 128,
+                        wx.IMAGE_QUALITY_HIGH).ConvertToBitmap()
+                dc.DrawBitmap(small, cx * 128, cy * 128, False)
+        if bitmap is not None:
+            dc.SelectObject(wx.NullBitmap)
+        return bitmap
 
     def drawlocaltile(self, frame, dc):
         """
         metodo che disegna un tile, può essere chiamato anche appena un tile
         viene scaricato, quindi bisogna controllare che il livello di zoom sia
-        conforme
+        conforme. Gli overlay sono disegnati sulla mappa una volta sola e la
+        bitmap composta viene messa in cache; finche' manca qualche overlay
+        si disegna la sola mappa, e se manca anche quella una tile di un
+        altro livello di zoom (vedi placeholder). self.missing sono i livelli
+        da scaricare, finche' non e' vuota la tile va ridisegnata.
         """
         x, y, _ = self.tile
         zoom = frame.zoom
         id = self.id
         dc.RemoveId(id)
         dc.ClearId(id)
-        dc.SetId(id)
-        img = self.loadtile()
         """dc.SetBrush(wx.GREY_BRUSH)
         dc.DrawRectangle(x*256,y*256,256,256)
         dc.DrawText(str(x)+","+str(y), x*256,y*256)"""
-        if(img is not None):
-            self.image = wx.Image(img[0], wx.BITMAP_TYPE_ANY).ConvertToBitmap()
-
-            a = dc.DrawBitmap(self.image, x * 256, y * 256, False)
+        # prima cerco la bitmap gia' decodificata, poi i file in cache; la
+        # bitmap resta solo nel pdc e nella cache, cosi' quando la tile esce
+        # dal pdc la memoria si libera
+        self.missing = []
+        image = frame.bitmaps.get(self.key)
+        if image is not None:
+            for map_type in self.layers:
+                frame.get_store(map_type).touch(*self.tile)
+        else:
+            layers = []
+            for map_type in self.layers:
+                bitmap = self.loadlayer(frame, map_type)
+                if bitmap is None:
+                    self.missing.append(map_type)
+                layers.append(bitmap)
+            image = layers[0]
+            if image is None:
+                image = self.placeholder(frame)
+            elif len(layers) > 1 and not self.missing:
+                image = composite(layers[0], layers[1:])
+                frame.bitmaps.put(self.key, image)
+        if(image is not None):
+            # l'oggetto nel pdc si crea solo se c'e' da disegnare: una tile
+            # non disegnata non finisce in frame.tiles, e il suo id non
+            # verrebbe piu' tolto da evict_tiles
+            dc.SetId(id)
+            a = dc.DrawBitmap(image, x * 256, y * 256, False)
             dc.SetIdBounds(id, wx.Rect(x * 256, y * 256, 256, 256))
             frame.objids.append(id)
             return True
@@ -132,55 +338,80 @@ class Tile:
             return False
 
 
-class MyMercator(globalmaptiles.GlobalMercator):
-    """
-    Estendo  la classe GlobalMercator, creando i due metodi che userò
-    nell'applicazione
-    """
-
-    def __init__(object):
-        globalmaptiles.GlobalMercator.__init__(object)
-
-    def pixels_to_lat_lon(self, x, y, zoom):
-        """
-        converte le coordinate da pixel a (lat, lon) per un certo zoom
-        """
-        mx, my = mercator.PixelsToMeters(x, y, zoom)
-        lat, lon = mercator.MetersToLatLon(mx, my)
-        #lat corretto
-        return -lat, lon
-
-    def lat_lon_to_pixels(self, lat, lon, zoom):
-        """
-        converte le coordinate da (lat, lon) a pixel per un certo zoom
-        """
-        mx, my = mercator.LatLonToMeters(lat, lon)
-        x, y = mercator.MetersToPixels(mx, my, zoom)
-        #correzione coordinata y (globalmaptiles ha l'origine sull'orizzonte, \
-        #python in alto a sinistra)
-        y = ((2 ** zoom) * 256) - y
-        return x, y
-
-mercator = MyMercator()
-
-
 class Marker:
-    img = wx.Image("images/marker.png", wx.BITMAP_TYPE_ANY)
+    icon = "images/marker.png"
+    # bitmap delle icone, convertite una volta sola per tutti i marker
+    symbols = {}
 
-    def __init__(self, lat, lon, name="", description=""):
+    def __init__(self, lat, lon, name="", description="", icon=None):
         self.lat = float(lat)
         self.lon = float(lon)
         self.name = name
         self.description = description
+        if icon is not None:
+            self.icon = icon
         self.id = wx.NewId()
+        # posizione in pixel dello zoom 0, calcolata una volta sola
+        self._world = None
+
+    @classmethod
+    def symbol(cls, icon):
+        """
+        Returns:
+            wx.Bitmap.  the bitmap of the icon file, loaded the first time
+        """
+        bitmap = cls.symbols.get(icon)
+        if bitmap is None:
+            bitmap = wx.Image(icon, wx.BITMAP_TYPE_ANY).ConvertToBitmap()
+            cls.symbols[icon] = bitmap
+        return bitmap
 
     def __str__(self):
         return str(self.lon) + "," + str(self.lat) + ",0"
 
+    def changed(self):
+        """
+        forgets the cached position, after lat or lon have been changed
+        """
+        self._world = None
+
+    def world(self):
+        """
+        Returns:
+            tuple.  (x, y) pixels of the marker at zoom 0
+        """
+        if self._world is None:
+            self._world = mercator.lat_lon_to_pixels(self.lat, self.lon, 0)
+        return self._world
+
     def getpixels(self, zoom):
-        x, y = mercator.lat_lon_to_pixels(self.lat, self.lon, zoom)
+        x, y = self.world()
+        factor = 2 ** zoom
+        return x * factor, y * factor
+
+    def bounds(self):
+        """
+        Returns:
+            tuple.  (minx, miny, maxx, maxy) of the marker in pixels of
+            zoom 0, as stored in the spatial index
+        """
+        x, y = self.world()
+        return x, y, x, y
 
-        return x, y
+    def hit(self, x, y, zoom, tolerance=0):
+        """
+        Returns:
+            float.  distance of the pixel (x, y) from the anchor of the
+            marker, if it falls on the icon, otherwise None
+        """
+        mx, my = self.getpixels(zoom)
+        symbol = self.symbol(self.icon)
+        sw, sh = symbol.GetWidth(), symbol.GetHeight()
+        left = mx - sw / 2
+        if (left - tolerance <= x <= left + sw + tolerance and
+                my - sh - tolerance <= y <= my + tolerance):
+            return math.hypot(x - mx, y - my)
+        return None
 
     def draw(self, frame, dc):
         id = self.id
@@ -189,28 +420,63 @@ class Marker:
         dc.SetId(id)
         zoom = frame.zoom
         x, y = self.getpixels(zoom)
-
-        # sposto il marker (largo 20 e alto 34 pixel) a sinistra di 10 e
-        # in alto di 34
-
-        x -= 10
-        y -= 34
-        dc.SetIdBounds(id, wx.Rect(x, y, 20, 34))
+        symbol = self.symbol(self.icon)
+        sw, sh = symbol.GetWidth(), symbol.GetHeight()
+
+        # sposto il marker (per l'icona predefinita largo 20 e alto 34
+        # pixel) a sinistra di meta' larghezza e in alto dell'altezza
+
+        x -= sw / 2
+        y -= sh
+        # il rettangolo comprende il nome, che e' ridisegnato solo se lo
+        # interseca
+        w, h = frame.GetTextExtent(self.name)
+        dc.SetIdBounds(id, wx.Rect(x, y, sw + 2 + w, max(sh, h + 1)))
         # Crea il DC e lo prepara per il disegno.
         #frame.dc.BeginDrawing()
-        frame.marker_img = self.img.ConvertToBitmap()
         # Disegna un'immagine senza la maschera trasparente.
-        img = dc.DrawBitmap(frame.marker_img, int(x), int(y), False)
+        img = dc.DrawBitmap(symbol, int(x), int(y), False)
         dc.SetBrush(wx.WHITE_BRUSH)
-        dc.DrawText(self.name, x + 20, y)
+        dc.DrawText(self.name, x + sw, y)
         dc.SetBrush(wx.BLACK_BRUSH)
-        dc.DrawText(self.name, x + 21, y + 1)
+        dc.DrawText(self.name, x + sw + 1, y + 1)
 
         # Finisce le operazioni di disegno.
         #frame.dc.EndDrawing()
         frame.objids.append(id)
 
 
+def cluster_radius(frame, count):
+    """
+    Returns:
+        int.  radius in pixels of the symbol of a group of count markers,
+        large enough for the number
+    """
+    w, _ = frame.GetTextExtent(str(count))
+    return max(CLUSTER_RADIUS, w / 2 + 4)
+
+
+def draw_cluster(cluster, frame, dc):
+    """
+    draws a group of markers as a circle with their number
+    """
+    if cluster.id is None:
+        cluster.id = wx.NewId()
+    id = cluster.id
+    dc.RemoveId(id)
+    dc.ClearId(id)
+    dc.SetId(id)
+    x, y = cluster.getpixels(frame.zoom)
+    text = str(len(cluster))
+    w, h = frame.GetTextExtent(text)
+    r = cluster.radius = cluster_radius(frame, len(cluster))
+    dc.SetIdBounds(id, wx.Rect(x - r - 1, y - r - 1, 2 * r + 3, 2 * r + 3))
+    dc.SetPen(wx.BLACK_PEN)
+    dc.SetBrush(wx.Brush(wx.Colour(255, 200, 0)))
+    dc.DrawCircle(int(x), int(y), r)
+    dc.DrawText(text, int(x - w / 2), int(y - h / 2))
+
+
 class LineString:
     """
     Percorso a linee spezzate
@@ -220,10 +486,97 @@ class LineString:
         self.description = description
         self.path = path
         self.id = wx.NewId()
+        self.changed()
 
     def __str__(self):
         return str(self.path)
 
+    def changed(self):
+        """
+        forgets the cached pixels, after the path has been changed
+        """
+        # vertici proiettati allo zoom 0, tutti insieme
+        self._world = None
+        # peso di Douglas-Peucker di ogni vertice, in pixel dello zoom 0
+        self._weights = None
+        # zoom -> (vertici semplificati, rettangolo)
+        self._pixels = {}
+
+    def world(self):
+        """
+        Returns:
+            tuple.  (xs, ys) lists of the pixels of the vertices at zoom 0
+        """
+        if self._world is None:
+            lats = [float(lat) for lat, _ in self.path]
+            lons = [float(lon) for _, lon in self.path]
+            xs, ys = mercator.lat_lon_to_pixels_many(lats, lons, 0)
+            # Douglas-Peucker, bounds e il filtro dei vertici li usano uno
+            # alla volta: con numpy sarebbero scalari lenti
+            self._world = tolist(xs), tolist(ys)
+        return self._world
+
+    def bounds(self):
+        """
+        Returns:
+            tuple.  (minx, miny, maxx, maxy) of the path in pixels of
+            zoom 0, as stored in the spatial index
+        """
+        xs, ys = self.world()
+        return min(xs), min(ys), max(xs), max(ys)
+
+    def pixels(self, zoom):
+        """
+        Returns:
+            list.  the (x, y) pixels of the vertices at zoom, without those
+            closer than SIMPLIFY_TOLERANCE pixels to the simplified path
+        """
+        return self._project(zoom)[0]
+
+    def box(self, zoom):
+        """
+        Returns:
+            tuple.  (minx, miny, maxx, maxy) of the path in pixels of zoom
+        """
+        return self._project(zoom)[1]
+
+    def _project(self, zoom):
+        projected = self._pixels.get(zoom)
+        if projected is None:
+            xs, ys = self.world()
+            if self._weights is None:
+                self._weights = geometry.simplify_weights(zip(xs, ys))
+            factor = 2 ** zoom
+            # i pesi sono dello zoom 0, la tolleranza scala con lo zoom
+            keep = geometry.simplify(self._weights,
+                    SIMPLIFY_TOLERANCE / float(factor))
+            coords = mercator.scale([xs[i] for i in keep],
+                    [ys[i] for i in keep], zoom)
+            box = tuple(v * factor for v in self.bounds())
+            projected = self._pixels[zoom] = (coords, box)
+        return projected
+
+    def hit(self, x, y, zoom, tolerance=0):
+        """
+        Returns:
+            float.  distance of the pixel (x, y) from the path, if it is
+            within tolerance pixels, otherwise None
+        """
+        coords = self.pixels(zoom)
+        if len(coords) == 1:
+            coords = coords * 2
+        best = None
+        for (x1, y1), (x2, y2) in zip(coords, coords[1:]):
+            # scarto subito i segmenti lontani
+            if (min(x1, x2) - tolerance > x or max(x1, x2) + tolerance < x or
+                    min(y1, y2) - tolerance > y or
+                    max(y1, y2) + tolerance < y):
+                continue
+            d = geometry.point_segment_distance(x, y, x1, y1, x2, y2)
+            if d <= tolerance and (best is None or d < best):
+                best = d
+        return best
+
     def draw(self, frame, dc):
         """
         disegna la linestring
@@ -232,27 +585,14 @@ class LineString:
         dc.RemoveId(id)
         dc.ClearId(id)
         dc.SetId(id)
-        coords = []
-        lat, lon = self.path[0]
-        minx, miny = mercator.lat_lon_to_pixels(
-                float(lat), float(lon), frame.zoom)
-        maxx, maxy = minx, miny
-        for p in self.path:
-            lat, lon = p
-            p_pixel = mercator.lat_lon_to_pixels(lat, lon, frame.zoom)
-            coords.append(p_pixel)
-            x, y = p_pixel
-            if minx > x:
-                minx = x
-            if miny > y:
-                miny = y
-            if maxx < x:
-                maxx = x
-            if maxy < y:
-                maxy = y
+        coords = self.pixels(frame.zoom)
+        minx, miny, maxx, maxy = self.box(frame.zoom)
 
         logging.debug("quadrato %d, %d, %d, %d", minx, miny, maxx, maxy)
-        dc.SetIdBounds(self.id, wx.Rect(minx, miny, maxx, maxy))
+        # wx.Rect vuole larghezza e altezza; un pixel in piu' per lo
+        # spessore della linea
+        dc.SetIdBounds(self.id, wx.Rect(minx - 1, miny - 1,
+                maxx - minx + 3, maxy - miny + 3))
         dc.SetBrush(wx.GREY_BRUSH)
         #dc.DrawRectangle(min,min,max,max)
         dc.SetBrush(wx.BLACK_BRUSH)
@@ -263,6 +603,53 @@ class LineString:
 (DownloadImageEvent, EVT_DOWNLOAD_IMAGE) = wx.lib.newevent.NewEvent()
 
 
+def geturl(tile):
+    x, y, zoom = tile.tile
+    return downloader.tile_url(tile.map_type, x, y, zoom)
+
+
+def cache_path(map_type):
+    """
+    Returns:
+        str.  the tile store of the cache of map_type, in DIR_CACHE
+    """
+    if CACHE_BACKEND == "mbtiles":
+        return DIR_CACHE + str(map_type) + ".mbtiles"
+    return DIR_CACHE + str(map_type) + "/"
+
+
+def savetile(store, tile, response):
+    """
+    writes a downloaded tile in the cache
+
+    Args:
+        store: the tile store of the cache of tile.map_type
+        tile (Tile): the downloaded tile
+        response (tuple): (http status, content type, body), None if the
+            server could not be reached
+
+    Returns:
+        bool.  True if the tile has been saved
+    """
+    x, y, zoom = tile.tile
+    if response is None:
+        failed_tiles.failed(tile.key)
+        return False
+    status, content_type, data = response
+    if status != 200:
+        logging.debug("tile %s: HTTP status %d", str(tile.key), status)
+        failed_tiles.failed(tile.key, downloader.is_permanent(status))
+        return False
+    try:
+        store.put(x, y, zoom, data, content_type)
+    except IOError as e:
+        logging.error("error: %s", e)
+        failed_tiles.failed(tile.key)
+        return False
+    failed_tiles.succeeded(tile.key)
+    return True
+
+
 class DownloadThread:
 
     def __init__(self, frame):
@@ -280,19 +667,16 @@ class DownloadThread:
 
     def downloadtile(self, tile):
         # if(x>=0 & y>=0 & zoom>=0):
-        x, y, zoom = map(str, tile.tile)
-        param = "&x=" + x + "&y=" + y + "&z=" + zoom
-
-        url = baseurlmap[MAP_TYPE] + param
-        filename = DIR_CACHE + "/" + x + "-" + y + "-" + zoom + ".png"
+        url = geturl(tile)
         #if (os.path.exists(filename)==False):
         #print url
         try:
-            url = urllib.urlretrieve(url, filename)
-            return url
+            response = self.frame.pool.fetch(url)
         except IOError as e:
             #offline
             logging.debug("image %s offline. %s", url, e)
+            response = None
+        return savetile(self.frame.get_store(tile.map_type), tile, response)
 
     def Run(self):
         #for tile in tiles:
@@ -300,16 +684,16 @@ class DownloadThread:
             logging.debug("t%s: begins loop", self.name)
             tile = tile_to_download.get()
             logging.debug("t%s: tile %s taken from queue",
-                                    self.name, str(tile.tile))
+                                    self.name, str(tile.key))
             self.img = self.downloadtile(tile)
             logging.debug("t%s: downloading tile %s",
-                                    self.name, str(tile.tile))
-            if(self.img is not False):
+                                    self.name, str(tile.key))
+            if(self.img):
                 evt = DownloadImageEvent(downloaded_tile=tile)
                 wx.PostEvent(self.frame, evt)
                 logging.debug("t%s: tile %s downloaded",
-                                    self.name, str(tile.tile))
-            tile_to_download.task_done()
+                                    self.name, str(tile.key))
+            tile_to_download.task_done(tile)
             logging.debug("t%s: ends loop", self.name)
             #self.running = False
 
@@ -387,33 +771,92 @@ class PyMapFrame(wx.Frame):
         self.Bind(wx.EVT_MENU, self.OnNewPath, id=ID_ADD_PATH)
         self.Bind(wx.EVT_MENU, self.OnExit, id=wx.ID_EXIT)
 
+        # un tipo di mappa alla volta, cambiarlo non riavvia niente
+        self.map_type = MAP_TYPE
+        viewmenu = wx.Menu()
+        for map_type in downloader.basemaps:
+            idtype = wx.NewId()
+            item = viewmenu.AppendRadioItem(idtype,
+                    downloader.mapnames[map_type],
+                    "Show the " + downloader.mapnames[map_type] + " map")
+            item.Check(map_type == self.map_type)
+            self.Bind(wx.EVT_MENU,
+                    lambda event, t=map_type: self.SetMapType(t), id=idtype)
+
+        # overlay disegnati sopra la mappa, dal basso verso l'alto
+        self.layers = list(OVERLAYS)
+        viewmenu.AppendSeparator()
+        for map_type in downloader.overlays:
+            idtype = wx.NewId()
+            item = viewmenu.AppendCheckItem(idtype,
+                    downloader.mapnames[map_type],
+                    "Show " + downloader.mapnames[map_type] + " over the map")
+            item.Check(map_type in self.layers)
+            self.Bind(wx.EVT_MENU, lambda event, t=map_type:
+                    self.SetOverlay(t, event.IsChecked()), id=idtype)
+
         self.Bind(EVT_DOWNLOAD_IMAGE, self.OnDownload)
+        self.Bind(wx.EVT_CLOSE, self.OnClose)
 
         # and put the menu on the menubar
         menuBar.Append(filemenu, "&File")
         menuBar.Append(insertmenu, "&Insert")
+        menuBar.Append(viewmenu, "&View")
         self.SetMenuBar(menuBar)
 
-        #array in cui vengono salvati tiles, markers e percorsi
-        self.tiles = []
-        self.layers = []
+        #array in cui vengono salvati markers e percorsi, le tile disegnate
+        #sono indicizzate per coordinate (x, y, zoom)
+        self.tiles = {}
+        self.bitmaps = BitmapCache()
+        #una cache su disco per ogni tipo di mappa, aperte al primo uso;
+        #CACHE_QUOTA vale per tutte insieme
+        self.stores = {}
+        self.cachequota = tilestore.QuotaGroup(CACHE_QUOTA)
+        self.storelock = thread.allocate_lock()
         self.markers = []
         self.LineStrings = []
 
-        sizeX, sizeY = self.sw.GetSize()
-        #self.sw.Scroll(sizeX/2, sizeY/2)
-        self.buffer = wx.EmptyBitmap(sizeX * 10, sizeY * 10)
+        #le richieste di tile mancanti vengono raccolte per QUEUE_WAIT secondi
+        #e passate alla coda tutte insieme
+        self.batcher = downloader.RequestBatcher(self.put_tiles_in_queue,
+                QUEUE_WAIT)
+        self.batcher.Start()
+
+        #tile che probabilmente verranno mostrate tra poco: quelle in cache
+        #vengono decodificate quando l'applicazione non ha altro da fare
+        self.prefetcher = prefetcher.Prefetcher()
+        self.predecode = []
+        self.Bind(wx.EVT_IDLE, self.OnIdle)
 
         self.pdc = wx.PseudoDC()
+        #marker e percorsi sono in un pdc a parte, disegnato sopra le tile:
+        #viene ridisegnato solo quando cambiano loro o lo zoom, non quando
+        #arriva una tile
+        self.vpdc = wx.PseudoDC()
+        self.vzoom = None
+        #indici spaziali dei percorsi e dei marker, e quelli disegnati in
+        #vpdc; quando i marker sono raggruppati il loro indice non serve
+        self.index = geometry.MultiGridIndex()
+        self.markerindex = geometry.MultiGridIndex()
+        #ai livelli di zoom bassi i marker vicini diventano un solo gruppo
+        self.clusters = clustering.ClusterGrid()
+        self.vdrawn = set()
         self.DoDrawing(self.pdc)
 
         self.CreateStatusBar()
 
-        #creo e faccio partire il thread che scarica le tile non presenti
-        for i in range(DOWNLOAD_THREAD_NUM):
-            DT = DownloadThread(self)
-            DT.name = str(i)
-            DT.Start()
+        #creo e faccio partire il thread che scarica le tile non presenti,
+        #i thread condividono le connessioni aperte verso i server
+        if DOWNLOAD_ENGINE == "async":
+            self.engine = downloader.AsyncDownloader(tile_to_download,
+                    geturl, self.OnTileFetched)
+            self.engine.Start()
+        else:
+            self.pool = downloader.ConnectionPool()
+            for i in range(DOWNLOAD_THREAD_NUM):
+                DT = DownloadThread(self)
+                DT.name = str(i)
+                DT.Start()
 
         #self.buffer = wx.EmptyBitmap(self.canvasSize,self.canvasSize)
         #self.dc = wx.BufferedDC(None, self.buffer)
@@ -487,35 +930,71 @@ class PyMapFrame(wx.Frame):
         rgn = self.sw.GetUpdateRegion()
         #print "region",rgn
         rgn.Offset(x, y)
-        sx, sy = self.sw.GetSize()
-        r = (x, y, sx, sy)
-        r = rgn.GetBox()
         #self.DoDrawing(self.pdc)
-        self.pdc.DrawToDCClipped(dc, r)
-        self.pdc.DrawToDC(dc)
+        # ridisegno una volta sola le operazioni che intersecano la regione
+        # da aggiornare; le tile lontane sono gia' state tolte dal pdc da
+        # evict_tiles
+        self.pdc.DrawToDCClippedRgn(dc, rgn)
+        self.vpdc.DrawToDCClippedRgn(dc, rgn)
         #print "linee",self.LineStrings
         """for l in self.LineStrings:
             print l.path"""
 
+    def get_store(self, map_type):
+        """
+        Returns:
+            the tile store of the cache of map_type, opened if needed; also
+            called by the download threads
+        """
+        with self.storelock:
+            store = self.stores.get(map_type)
+            if store is None:
+                # la prima volta l'indice della cache si costruisce in un
+                # thread, la mappa intanto si vede lo stesso
+                store = tilestore.open_store(cache_path(map_type), True,
+                        0, CACHE_MAX_AGE, background=True,
+                        group=self.cachequota)
+                self.stores[map_type] = store
+            return store
+
+    def OnTileFetched(self, tile, response):
+        """
+        called by the async download engine, in its own thread, when the
+        download of a tile ends
+        """
+        if savetile(self.get_store(tile.map_type), tile, response):
+            wx.PostEvent(self, DownloadImageEvent(downloaded_tile=tile))
+
     def OnDownload(self, evt):
         """
-        when a tile is downloaded, it will be drown (if the zoom is correct)
+        when a tile is downloaded, it will be drown (if the zoom is correct
+        and it is the map or one of the overlays shown)
         """
         if (evt.downloaded_tile is not None and
-                (evt.downloaded_tile.tile[2] == self.zoom)):
-            newTile = evt.downloaded_tile
+                (evt.downloaded_tile.tile[2] == self.zoom) and
+                evt.downloaded_tile.map_type in self.shown_layers()):
+            downloaded = evt.downloaded_tile
             #print "onDownload " + str(newTile.tile)
+            # ridisegno la tile visualizzata, di cui quella scaricata e' un
+            # livello
+            newTile = self.tiles.get(downloaded.tile)
+            if newTile is None:
+                x, y, zoom = downloaded.tile
+                newTile = Tile(x, y, zoom, self.map_type, self.layers)
+            # il file appena scaricato sostituisce l'eventuale bitmap vecchia
+            self.bitmaps.discard(downloaded.key)
+            self.bitmaps.discard(newTile.key)
+            self.bitmaps.discard(("placeholder",) + newTile.key)
             dc = self.pdc
             dc.BeginDrawing()
-            newTile.drawlocaltile(self, dc)
-            for m in self.markers:
-                m.draw(self, dc)
-            for p in self.LineStrings:
-                p.draw(self, dc)
-                #points.append(m.getpixels(zoom))
-            #dc.DrawLines(points, xoffset=0, yoffset=0)
+            if newTile.drawlocaltile(self, dc):
+                self.tiles[newTile.tile] = newTile
             dc.EndDrawing()
-            self.OnPaint(evt)
+            # ridisegno solo il quadrato della tile: i marker e i percorsi
+            # sono in self.vpdc e vengono ripetuti solo se lo intersecano
+            x, y, _ = newTile.tile
+            cx, cy = self.sw.CalcScrolledPosition((x * 256, y * 256))
+            self.sw.RefreshRect(wx.Rect(cx, cy, 256, 256), False)
 
     def OnScroll(self, evt):
         """if(evt.GetPosition()==wx.HORIZONTAL):
@@ -523,17 +1002,24 @@ class PyMapFrame(wx.Frame):
         if(evt.GetPosition()==wx.VERTICAL):
             print "verticale"""
         self.DoDrawing(self.pdc)
-        self.OnPaint(evt)
+        self.sw.Refresh(False)
 
-    def put_tile_in_queue(self, tile):
+    def shown_layers(self):
         """
-        if the tile belongs to this zoom, it is put in the queue to be download
-        by the downloadthread
+        Returns:
+            list.  the map type and the overlays shown
         """
+        return [self.map_type] + self.layers
 
-        if(tile.tile[2] == self.zoom):
-            tile_to_download.put(tile)
-            #print "messo",tile.tile
+    def put_tiles_in_queue(self, tiles):
+        """
+        the tiles that belong to this zoom and to the layers shown are put in
+        the queue to be downloaded by the downloadthread
+        """
+        zoom = self.zoom
+        layers = self.shown_layers()
+        tile_to_download.put_many([t for t in tiles
+                if t.tile[2] == zoom and t.map_type in layers])
 
     #disegna la mappa e gli oggetti all'interno dell'area attualmente visibile
     def DoDrawing(self, dc):
@@ -553,6 +1039,8 @@ class PyMapFrame(wx.Frame):
         minX, minY = (xv * dx, yv * dy)
 
         maxX, maxY = self.sw.GetSize()
+        center = ((minX + maxX / 2.0) / 256, (minY + maxY / 2.0) / 256)
+        self.prefetcher.moved(zoom, center, (maxX / 256.0, maxY / 256.0))
         minX = int(math.floor(minX / 256))  # floor: approssimazione p difetto
         minY = int(math.floor(minY / 256))
 
@@ -566,47 +1054,265 @@ class PyMapFrame(wx.Frame):
         if(maxY > 2 ** zoom):
             maxY = 2 ** zoom
 
-        found = False
+        # le tile in coda che non servono piu' non verranno scaricate
+        tile_to_download.set_viewport(zoom, (minX, minY, maxX, maxY), center,
+                self.shown_layers())
+
         for x in range(minX, maxX):
             for y in range(minY, maxY):
 
-                # controllo se il tile e' gia' stato disegnato
-                for t in self.tiles:
-                    if t.tile == (x, y, zoom):
-                        found = True
-
-                # se non e' gia' stato disegnato, creo l'oggetto
-                if not found:
-                    newTile = Tile(x, y, zoom)
+                # se il tile non e' gia' stato disegnato, creo l'oggetto
+                newTile = self.tiles.get((x, y, zoom))
+                if newTile is None:
+                    newTile = Tile(x, y, zoom, self.map_type, self.layers)
                     #print "creato",newTile.tile
 
-                    #se riesco a disegnarlo, lo metto nel vettore
+                    #se riesco a disegnarlo, anche solo con un segnaposto,
+                    #lo metto nell'indice
                     if newTile.drawlocaltile(self, dc):
-                        self.tiles.append(newTile)
-                    else:
-                        # aggiungo alla coda il tile da scaricare aspettando
-                        # QUEUE_WAIT secondi
-                        if(not tile_to_download.full()):
-                            t = Timer(QUEUE_WAIT, self.put_tile_in_queue,
-                                            args=[newTile, ])
-                            t.start()
-
-                            #tile_to_download.put(newTile)
-                            #print "messo",newTile.tile
+                        self.tiles[newTile.tile] = newTile
+                # aggiungo alla coda i livelli da scaricare aspettando
+                # QUEUE_WAIT secondi, vengono scaricati in parallelo; le
+                # tile incomplete gia' disegnate vengono richieste di nuovo
+                for map_type in newTile.missing:
+                    layer = Tile(x, y, zoom, map_type)
+                    if not failed_tiles.blocked(layer.key):
+                        self.batcher.add(layer)
+
+                        #tile_to_download.put(newTile)
+                        #print "messo",newTile.tile
                 #print x,y
-            found = False
 
-        #disegno i markers
-        for m in self.markers:
-            m.draw(self, dc)
+        self.evict_tiles(dc, minX, minY, maxX, maxY)
 
-        #disegno i path
-        for p in self.LineStrings:
-            p.draw(self, dc)
+        #disegno i markers e i path vicini alla finestra
+        self.DrawVectors()
 
         # Finisce le operazioni di disegno.
         dc.EndDrawing()
+        self.prefetch()
         logging.debug("tile in memoria: %d", len(self.tiles))
+        logging.debug("bitmap cache: %s", self.bitmaps.stats())
+        logging.debug("tile cache: %s",
+                self.get_store(self.map_type).stats())
+
+    def prefetch(self):
+        """
+        asks the prefetcher which tiles will be shown soon: those in the
+        cache are decoded in OnIdle, the others are queued for download
+        with low priority
+        """
+        layers = self.shown_layers()
+        downloads = []
+        self.predecode = []
+        for x, y, zoom in self.prefetcher.tiles():
+            for map_type in layers:
+                key = (x, y, zoom, map_type)
+                if key in self.bitmaps:
+                    continue
+                if self.get_store(map_type).has(x, y, zoom):
+                    self.predecode.append(key)
+                elif PREFETCH_RATE and not failed_tiles.blocked(key):
+                    downloads.append(Tile(x, y, zoom, map_type))
+        tile_to_download.prefetch(downloads)
+        logging.debug("prefetch: %d to decode, %d to download",
+                len(self.predecode), len(downloads))
+
+    def OnIdle(self, event):
+        """
+        decodes a few of the tiles that will probably be shown soon
+        """
+        for key in self.predecode[:PREDECODE_PER_IDLE]:
+            x, y, zoom, map_type = key
+            Tile(x, y, zoom, map_type).loadlayer(self, map_type)
+        del self.predecode[:PREDECODE_PER_IDLE]
+        if self.predecode:
+            event.RequestMore()
+
+    def view_box(self, margin=0):
+        """
+        Returns:
+            tuple.  the visible area enlarged by margin pixels, in pixels
+            of zoom 0 like the boxes of the spatial indexes
+        """
+        xv, yv = self.sw.GetViewStart()
+        dx, dy = self.sw.GetScrollPixelsPerUnit()
+        w, h = self.sw.GetSize()
+        x, y = xv * dx, yv * dy
+        scale = 2.0 ** self.zoom
+        return ((x - margin) / scale, (y - margin) / scale,
+                (x + w + margin) / scale, (y + h + margin) / scale)
+
+    def clustered(self):
+        """
+        Returns:
+            bool.  True if at the current zoom the markers are grouped
+        """
+        return self.zoom <= self.clusters.maxzoom
+
+    def query_features(self, box):
+        """
+        Returns:
+            list.  the paths and the markers in box, a zoom 0 box like
+            those of view_box; where the markers are grouped, the Clusters
+            of overlapping markers take their place
+        """
+        features = self.index.query(box, self.zoom)
+        if self.clustered():
+            return features + self.clusters.query(self.zoom, box)
+        return features + self.markerindex.query(box, self.zoom)
+
+    def feature_index(self, feature):
+        """
+        Returns:
+            the spatial index of the marker or path feature
+        """
+        if isinstance(feature, Marker):
+            return self.markerindex
+        return self.index
+
+    def DrawVectors(self, force=False):
+        """
+        draws in self.vpdc the markers and the paths near the visible area
+        that are not drawn yet, found with the spatial index, and removes
+        those far from it; when the zoom changes, or force is True, the
+        whole vpdc is drawn again
+        """
+        dc = self.vpdc
+        if self.vzoom != self.zoom or force:
+            self.vzoom = self.zoom
+            dc.RemoveAll()
+            self.vdrawn = set()
+        visible = self.query_features(self.view_box(VECTOR_MARGIN))
+        new = [f for f in visible if f not in self.vdrawn]
+        if new:
+            dc.BeginDrawing()
+            # i marker sopra i percorsi
+            for f in new:
+                if isinstance(f, LineString):
+                    f.draw(self, dc)
+            for f in new:
+                if isinstance(f, Marker):
+                    f.draw(self, dc)
+                elif isinstance(f, clustering.Cluster):
+                    draw_cluster(f, self, dc)
+            dc.EndDrawing()
+            self.vdrawn.update(new)
+        if len(self.vdrawn) > len(visible):
+            keep = set(self.query_features(
+                    self.view_box(VECTOR_KEEP_MARGIN)))
+            for f in [f for f in self.vdrawn if f not in keep]:
+                dc.RemoveId(f.id)
+                dc.ClearId(f.id)
+                self.vdrawn.discard(f)
+
+    def HitTest(self, x, y, tolerance=HIT_TOLERANCE):
+        """
+        finds the marker, the group of markers or the path under the pixel
+        (x, y) of the current zoom, checking only the candidates of the
+        spatial index; markers are drawn over the paths and win over them
+
+        Returns:
+            the marker, the Cluster or the path nearest to (x, y), None if
+            there is none
+        """
+        zoom = self.zoom
+        scale = 2.0 ** zoom
+        # un marker sta sopra il suo punto: allargo la ricerca verso il
+        # basso della dimensione delle icone; un gruppo e' un cerchio
+        # intorno al suo centro, al massimo grande come quello di tutti i
+        # marker
+        near = tolerance + cluster_radius(self, len(self.clusters))
+        margin = max([near] + [max(b.GetWidth(), b.GetHeight())
+                for b in Marker.symbols.values()])
+        box = ((x - margin) / scale, (y - near) / scale,
+                (x + margin) / scale, (y + margin) / scale)
+        best = None
+        for feature in self.query_features(box):
+            d = feature.hit(x, y, zoom, tolerance)
+            if d is None:
+                continue
+            rank = (isinstance(feature, LineString), d)
+            if best is None or rank < best[0]:
+                best = (rank, feature)
+        if best is None:
+            return None
+        return best[1]
+
+    def AddFeatures(self, features):
+        """
+        adds markers and paths to the map, putting them in the spatial
+        indexes and in the clusters in a single pass
+        """
+        for f in features:
+            if isinstance(f, Marker):
+                self.markers.append(f)
+            else:
+                self.LineStrings.append(f)
+        # proietto insieme le posizioni dei marker, per esempio di un kml
+        markers = [f for f in features
+                if isinstance(f, Marker) and f._world is None]
+        if markers:
+            xs, ys = mercator.lat_lon_to_pixels_many(
+                    [m.lat for m in markers], [m.lon for m in markers], 0)
+            for m, x, y in zip(markers, xs, ys):
+                m._world = (float(x), float(y))
+        markers = [f for f in features if isinstance(f, Marker)]
+        self.index.insert_many((f, f.bounds()) for f in features
+                if not isinstance(f, Marker))
+        self.markerindex.insert_many((m, m.bounds()) for m in markers)
+        self.clusters.insert_many((m, m.world()) for m in markers)
+        # i gruppi cambiati vanno ridisegnati
+        self.DrawVectors(force=bool(markers) and self.clustered())
+        self.sw.Refresh(False)
+
+    def UpdateFeature(self, feature):
+        """
+        draws again a marker or a path after it has been changed
+        """
+        feature.changed()
+        self.feature_index(feature).insert(feature, feature.bounds())
+        self.vdrawn.discard(feature)
+        self.vpdc.RemoveId(feature.id)
+        self.vpdc.ClearId(feature.id)
+        marker = isinstance(feature, Marker)
+        if marker:
+            self.clusters.insert(feature, feature.world())
+        self.DrawVectors(force=marker and self.clustered())
+        self.sw.Refresh(False)
+
+    def RemoveFeature(self, feature):
+        """
+        removes a marker or a path from the map
+        """
+        if isinstance(feature, Marker):
+            self.markers.remove(feature)
+            self.clusters.remove(feature)
+        else:
+            self.LineStrings.remove(feature)
+        self.feature_index(feature).remove(feature)
+        self.vdrawn.discard(feature)
+        self.vpdc.RemoveId(feature.id)
+        self.vpdc.ClearId(feature.id)
+        if isinstance(feature, Marker) and self.clustered():
+            self.DrawVectors(force=True)
+        self.sw.Refresh(False)
+
+    def evict_tiles(self, dc, minX, minY, maxX, maxY):
+        """
+        removes from the index and from the dc the tiles farther than
+        TILE_KEEP_MARGIN tiles from the visible area
+        """
+        minX -= TILE_KEEP_MARGIN
+        minY -= TILE_KEEP_MARGIN
+        maxX += TILE_KEEP_MARGIN
+        maxY += TILE_KEEP_MARGIN
+        far = [key for key in self.tiles
+                if not (minX <= key[0] < maxX and minY <= key[1] < maxY)]
+        for key in far:
+            id = self.tiles.pop(key).id
+            dc.RemoveId(id)
+            dc.ClearId(id)
 
     def Zoom(self, lat, lon, zoom, event=None):
         #svuoto la coda tile_to_download
@@ -622,7 +1328,7 @@ class PyMapFrame(wx.Frame):
         for m in self.markers:
             self.pdc.RemoveId(m.id)
             self.pdc.ClearId(m.id)"""
-        self.tiles = []
+        self.tiles = {}
         if zoom <= 3:
             self.pdc.Clear()
         self.zoom = zoom
@@ -633,14 +1339,50 @@ class PyMapFrame(wx.Frame):
         #self.DoDrawing(self.pdc)
         self.LookAt(lat, lon, self.zoom)
         #self.DoDrawing(self.pdc)
-        self.OnPaint(event)
+        self.sw.Refresh(False)
+
+    def SetMapType(self, map_type):
+        """
+        shows the map of another type without losing anything: the bitmaps
+        already decoded stay in self.bitmaps and are reused when switching
+        back, while the queued downloads of the old type are dropped by the
+        scheduler at the next redraw
+        """
+        if map_type == self.map_type:
+            return
+        logging.debug("map type %d -> %d", self.map_type, map_type)
+        self.map_type = map_type
+        self.Redraw()
+
+    def SetOverlay(self, map_type, shown):
+        """
+        shows or hides an overlay; the composite tiles already made for a
+        set of overlays stay in self.bitmaps
+        """
+        if shown == (map_type in self.layers):
+            return
+        if shown:
+            self.layers = [t for t in downloader.overlays
+                    if t in self.layers or t == map_type]
+        else:
+            self.layers.remove(map_type)
+        self.Redraw()
+
+    def Redraw(self):
+        """
+        draws again all the visible tiles, after the layers shown change
+        """
+        self.pdc.RemoveAll()
+        self.tiles = {}
+        self.DoDrawing(self.pdc)
+        self.sw.Refresh(False)
 
     def OnSlide(self, event):
         """
         metodo chiamato quando si muove lo slider: cambia il livello dello
         zoom centrando mantenendo lo stesso centro dell'immagine
         """
-        self.tiles = []
+        self.tiles = {}
         xFrame, yFrame = self.sw.GetSize()
         xCenter = xFrame / 2
         yCenter = yFrame / 2
@@ -652,6 +1394,8 @@ class PyMapFrame(wx.Frame):
         logging.debug("lat=%s, lon=%s", str(lat), str(lon))
         #self.slider.SetValue(self.zoom)
         #self.DoDrawing(self.pdc)
+        if self.slider.GetValue() != self.zoom:
+            self.prefetcher.zoomed(cmp(self.slider.GetValue(), self.zoom))
         self.zoom = self.slider.GetValue()
         #self.slider.SetValue(self.zoom)
         self.Zoom(lat, lon, self.zoom, event)
@@ -684,12 +1428,12 @@ class PyMapFrame(wx.Frame):
             name = dialog.name.GetValue()
             description = dialog.description.GetValue()
             newMarker = Marker(lat, lon, name, description)
-            self.markers.append(newMarker)
-            newMarker.draw(self, self.pdc)
+            self.AddFeatures([newMarker])
         dialog.Destroy()
 
     def OnNewPath(self, event):
         self.tempPath = []
+        self.templine = LineString(path=self.tempPath)
         self.mode = "path"
         self.NewPathDialog(event)
 
@@ -707,66 +1451,30 @@ class PyMapFrame(wx.Frame):
         #creo il nuovo oggetto linestring e lo aggiungo al vettore dei
         #       linestring
         newLineString = LineString(name, description, self.tempPath)
-        self.LineStrings.append(newLineString)
+        self.vpdc.RemoveId(self.templine.id)
+        self.vpdc.ClearId(self.templine.id)
+        if self.tempPath:
+            self.AddFeatures([newLineString])
 
         #ripristino la modalita' select e chiudo la finestra newpath
         self.mode = "select"
         self.PathDialog.Destroy()
 
     def load_kml(self, namefile):
-        #carica i markers da file kml e restituisce la lista di markers
+        #carica i markers da file kml e restituisce la lista di markers;
+        #vengono indicizzati tutti insieme e disegnati solo quelli visibili
         markers = []
-        import xml.dom.minidom
-        from xml.dom.minidom import Node
-
-        doc = xml.dom.minidom.parse(namefile)
-        p_name = ""
-        p_description = ""
-        for node in doc.getElementsByTagName("Placemark"):
-            name = node.getElementsByTagName("name")
-
-            for node1 in name:
-                for n in node1.childNodes:
-                    p_name = n.data.encode('utf8')
-                    logging.debug("p_name=%s", str(p_name))
-
-            description = node.getElementsByTagName("description")
-            for desc in description:
-                for des in desc.childNodes:
-                    p_description = (des.data).encode('utf8')
-                    logging.debug("p_description=%s", str(p_description))
-
-            point = node.getElementsByTagName("Point")
-            if len(point) > 0:
-                for node2 in point:
-                    coordinates = node2.getElementsByTagName("coordinates")
-                    for node3 in coordinates:
-                        for node4 in node3.childNodes:
-                            p_coordinates = node4.data.encode('utf8')
-                            #print p_coordinates
-                            lon, lat, hi = p_coordinates.split(",")
-                            newMarker = Marker(lat, lon, p_name, p_description)
-                            self.markers.append(newMarker)
-                            newMarker.draw(self, self. pdc)
-
-            linestring = node.getElementsByTagName("LineString")
-            if len(linestring) > 0:
-                for node2 in linestring:
-                    newpath = []
-                    coordinates = node2.getElementsByTagName("coordinates")
-                    for node3 in coordinates:
-                        for node4 in node3.childNodes:
-                            p_coordinates = node4.data.encode('utf8')
-                            co = p_coordinates.split("\n")
-                            #print "righe",co
-                            for p in co:
-                                if(p.strip() != ""):
-                                    #print "riga",p
-                                    lon, lat, hi = p.split(",")
-                                    newpath.append((float(lat), float(lon)))
-                                    #print newpath
-                    newLineString = LineString(path=newpath)
-                    self.LineStrings.append(newLineString)
+        features = []
+        for kind, p_name, p_description, points in \
+                kmlparser.parse_kml(namefile):
+            if kind == "point":
+                lat, lon = points[0]
+                newMarker = Marker(lat, lon, p_name, p_description)
+                markers.append(newMarker)
+                features.append(newMarker)
+            elif kind == "linestring" and points:
+                features.append(LineString(path=points))
+        self.AddFeatures(features)
 
         return markers
 
@@ -776,7 +1484,7 @@ class PyMapFrame(wx.Frame):
             self.popupID1 = wx.NewId()
             self.popupID2 = wx.NewId()
 
-        def UpdateMarkerDialog(self, marker=marker):
+        def UpdateMarkerDialog(event, marker=marker):
             dialog = marker_dialog.MarkerDialog(None, -1, "")
             dialog.coordinates.SetValue(str(marker.lat) + "," +
                     str(marker.lon))
@@ -793,16 +1501,12 @@ class PyMapFrame(wx.Frame):
                 marker.description = dialog.description.GetValue()
                 #newMarker=Marker(lat,lon,name,description)
                 #self.markers.append(newMarker)
-                #marker.draw(self,self.pdc)
+                self.UpdateFeature(marker)
             dialog.Destroy()
 
         def Ondelete(event, marker=marker):
-            id = marker.id
-            self.pdc.RemoveId(id)
-            self.pdc.ClearId(id)
-            self.markers.remove(marker)
+            self.RemoveFeature(marker)
             menu.Destroy
-            self.OnPaint(event)
 
         #self.Bind(wx.EVT_MENU, self.Ondelete, id=self.popupID1)
         self.Bind(wx.EVT_MENU, UpdateMarkerDialog, id=self.popupID1)
@@ -843,12 +1547,8 @@ class PyMapFrame(wx.Frame):
             dialog.Destroy()
 
         def Ondelete(event, linestring=LineString):
-            id = linestring.id
-            self.pdc.RemoveId(id)
-            self.pdc.ClearId(id)
-            self.LineStrings.remove(linestring)
+            self.RemoveFeature(linestring)
             menu.Destroy
-            self.OnPaint(event)
 
         #self.Bind(wx.EVT_MENU, self.Ondelete, id=self.popupID1)
         self.Bind(wx.EVT_MENU, UpdateLineStringDialog, id=self.popupID1)
@@ -872,7 +1572,7 @@ class PyMapFrame(wx.Frame):
         def OnNewPoint(event, coord=coord):
             self.NewPointDialog(coord)
             menu.Destroy
-            self.OnPaint(event)
+            self.sw.Refresh(False)
 
         self.Bind(wx.EVT_MENU, OnNewPoint, id=self.popupIDnew)
         # make a menu
@@ -889,6 +1589,7 @@ class PyMapFrame(wx.Frame):
         x, y = self.ConvertEventCoords(event)
         lat, lon = mercator.pixels_to_lat_lon(x, y, self.zoom)
         self.SetStatusText(str(lat) + "," + str(lon))
+        self.prefetcher.pointed(x / 256.0, y / 256.0, self.zoom)
 
         if event.LeftDown():
             #se sono in modalità "disegna percorso":
@@ -899,9 +1600,9 @@ class PyMapFrame(wx.Frame):
                 #newmarker.draw(self,dc)
                 point = (lat, lon)
                 self.tempPath.append(point)
+                self.templine.changed()
                 coords = []
-                ls = LineString(path=self.tempPath)
-                ls.draw(self, self.pdc)
+                self.templine.draw(self, self.vpdc)
                 #print self.tempPath
             else:
 
@@ -914,31 +1615,28 @@ class PyMapFrame(wx.Frame):
                 #print "lat,lon",lat,lon
                 self.LookAt(lat, lon, self.zoom)
                 #self.Zoom(self.zoom,lat,lon)
-                l = self.pdc.FindObjects(x, y, 5)
 
                 self.DoDrawing(self.pdc)
-            self.OnPaint(event)
+            self.sw.Refresh(False)
 
         elif event.RightDown():
             x, y = self.ConvertEventCoords(event)
-            l = self.pdc.FindObjects(x, y, 1)  # lista di id oggetti disegnati
-            #print l
-            found = False
-            for id in l:
-                for m in self.markers:
-                    if m.id == id:
-                        """self.pdc.RemoveId(id)
-                        self.pdc.ClearId(id)
-                        self.lastpos = (event.GetX(),event.GetY())"""
-                        self.OnContextMenuMarker(m)
-                        found = True
-                for line in self.LineStrings:
-                    if line.id == id:
-                        self.OnContextMenuLineString(line)
-                        found = True
-                if found:
-                    break
-            if not found:
+            # oggetto sotto il mouse, cercato con l'indice spaziale
+            feature = self.HitTest(x, y)
+            if isinstance(feature, Marker):
+                self.OnContextMenuMarker(feature)
+            elif isinstance(feature, clustering.Cluster):
+                # un gruppo di marker si apre ingrandendo la mappa su di lui
+                cx, cy = feature.getpixels(self.zoom)
+                lat, lon = mercator.pixels_to_lat_lon(cx, cy, self.zoom)
+                if self.zoom != 22:
+                    self.prefetcher.zoomed(1)
+                    self.zoom += 1
+                    self.slider.SetValue(self.zoom)
+                    self.Zoom(lat, lon, self.zoom, event)
+            elif feature is not None:
+                self.OnContextMenuLineString(feature)
+            else:
                 lat, lon = mercator.pixels_to_lat_lon(x, y, self.zoom)
                 #new point
                 coord = str(lat) + "," + str(lon)
@@ -949,6 +1647,7 @@ class PyMapFrame(wx.Frame):
             lat, lon = mercator.pixels_to_lat_lon(x, y, self.zoom)
             #self.slider.SetValue(self.zoom)
             if (self.zoom != 22):
+                self.prefetcher.zoomed(1)
                 self.zoom += 1
                 #self.DoDrawing(self.pdc)
                 self.slider.SetValue(self.zoom)
@@ -959,6 +1658,7 @@ class PyMapFrame(wx.Frame):
             lat, lon = mercator.pixels_to_lat_lon(x, y, self.zoom)
             #self.slider.SetValue(self.zoom)
             if (self.zoom != 0):
+                self.prefetcher.zoomed(-1)
                 self.zoom -= 1
                 #self.DoDrawing(self.pdc)
                 self.slider.SetValue(self.zoom)
@@ -984,7 +1684,7 @@ class PyMapFrame(wx.Frame):
                 self.load_kml(pat)
         dlg.Destroy()
         self.DoDrawing(self.pdc)
-        self.OnPaint(event)
+        self.sw.Refresh(False)
 
     def OnOpen(self, event):
         #self.OnNew(event)
@@ -992,16 +1692,14 @@ class PyMapFrame(wx.Frame):
         #self.DoDrawing(self.pdc)
 
     def OnNew(self, event):
-        for m in self.markers:
-            self.pdc.RemoveId(m.id)
-            self.pdc.ClearId(m.id)
+        self.vpdc.RemoveAll()
+        self.vdrawn = set()
+        self.index.clear()
+        self.markerindex.clear()
+        self.clusters.clear()
         self.markers = []
-        self.OnPaint(event)
-
-        for l in self.LineStrings:
-            self.pdc.RemoveId(l.id)
-            self.pdc.ClearId(l.id)
         self.LineStrings = []
+        self.sw.Refresh(False)
         self.DoDrawing(self.pdc)
 
     def create_kml(self):
@@ -1092,13 +1790,16 @@ class PyMapFrame(wx.Frame):
         # Distrugge il frame.
         self.Close(1)
 
+    def OnClose(self, event):
+        # scrivo le tile ancora in attesa nella cache
+        with self.storelock:
+            for store in self.stores.values():
+                store.flush()
+        event.Skip()
+
 
 class PyMap(wx.App):
     def OnInit(self):
-        #create cache folder if it does not exist
-        d = os.path.dirname(DIR_CACHE)
-        if not os.path.exists(d):
-            os.makedirs(d)
         frame = PyMapFrame()
         frame.Show(1)
         self.SetTopWindow(frame)
@@ -1106,6 +1807,38 @@ class PyMap(wx.App):
 
 
 def main():
+    global DOWNLOAD_ENGINE, CACHE_BACKEND, CACHE_QUOTA, CACHE_MAX_AGE
+    global MAP_TYPE, OVERLAYS
+    parser = OptionParser()
+    parser.add_option("--engine", choices=["threads", "async"],
+            default=DOWNLOAD_ENGINE,
+            help="tile download engine: threads or async")
+    parser.add_option("--cache", choices=["files", "mbtiles"],
+            default=CACHE_BACKEND,
+            help="offline cache: files (one per tile) or mbtiles")
+    parser.add_option("--cache-quota", type="float",
+            default=CACHE_QUOTA / 1048576.0, metavar="MB",
+            help="max size of the offline cache in MB, all the map types "
+            "together, 0 for no limit")
+    parser.add_option("--cache-max-age", type="float",
+            default=CACHE_MAX_AGE / 86400.0, metavar="DAYS",
+            help="days after which a cached tile is downloaded again, "
+            "0 for never")
+    parser.add_option("--map-type", type="choice", default=str(MAP_TYPE),
+            choices=[str(t) for t in downloader.basemaps],
+            help="map shown at startup, see downloader.baseurlmap")
+    parser.add_option("--overlay", type="choice", action="append",
+            choices=[str(t) for t in downloader.overlays],
+            help="overlay shown over the map at startup, can be repeated")
+    options, args = parser.parse_args()
+    MAP_TYPE = int(options.map_type)
+    if options.overlay:
+        OVERLAYS = [t for t in downloader.overlays
+                if str(t) in options.overlay]
+    DOWNLOAD_ENGINE = options.engine
+    CACHE_BACKEND = options.cache
+    CACHE_QUOTA = int(options.cache_quota * 1048576)
+    CACHE_MAX_AGE = options.cache_max_age * 86400
     app = PyMap()
     app.MainLoop()
 
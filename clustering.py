@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    This file is part of wxpymaps.
+#
+#    wxpymaps is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    wxpymaps is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with wxpymaps.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""groups the markers that overlap at low zoom levels, does not need wx"""
+
+import math
+
+CLUSTER_CELL = 64  # lato in pixel delle celle in cui si raggruppano i marker
+CLUSTER_MAX_ZOOM = 15  # oltre questo zoom i marker non vengono raggruppati
+
+
+class Cluster:
+    """
+    The markers of a cell of the grid of a zoom level, shown as a single
+    symbol at their centroid.
+    """
+
+    def __init__(self, zoom):
+        self.zoom = zoom
+        self.items = set()
+        self.sx = 0.0
+        self.sy = 0.0
+        # assegnati da chi lo disegna: id nel pseudo dc e raggio in pixel
+        self.id = None
+        self.radius = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item, x, y):
+        self.items.add(item)
+        self.sx += x
+        self.sy += y
+
+    def remove(self, item, x, y):
+        self.items.discard(item)
+        self.sx -= x
+        self.sy -= y
+
+    def getpixels(self, zoom):
+        """
+        Returns:
+            tuple.  (x, y) pixels of the centroid of the markers at zoom
+        """
+        factor = 2 ** zoom / float(len(self.items))
+        return self.sx * factor, self.sy * factor
+
+    def hit(self, x, y, zoom, tolerance=0):
+        """
+        Returns:
+            float.  distance of the pixel (x, y) from the centroid, if it
+            falls on the symbol, otherwise None
+        """
+        cx, cy = self.getpixels(zoom)
+        d = math.hypot(x - cx, y - cy)
+        if d <= self.radius + tolerance:
+            return d
+        return None
+
+
+class ClusterGrid:
+    """
+    Groups the markers with a grid of cells of cellsize pixels for each zoom
+    level up to maxzoom: the markers in the same cell become a Cluster. A
+    level is built the first time it is queried and then kept up to date
+    as markers are inserted and removed, so moving around a zoom level
+    costs nothing.
+    """
+
+    def __init__(self, cellsize=CLUSTER_CELL, maxzoom=CLUSTER_MAX_ZOOM):
+        """
+        Args:
+            cellsize (float): side of the cells, in pixels of every zoom
+            maxzoom (int): last zoom level where markers are grouped
+        """
+        self.cellsize = cellsize
+        self.maxzoom = maxzoom
+        self._points = {}  # marker -> (x, y) in pixel dello zoom 0
+        self._levels = {}  # zoom -> {(col, row): Cluster}
+
+    def __len__(self):
+        return len(self._points)
+
+    def __contains__(self, item):
+        return item in self._points
+
+    def _cell(self, x, y, zoom):
+        scale = 2 ** zoom / float(self.cellsize)
+        return int(math.floor(x * scale)), int(math.floor(y * scale))
+
+    def _place(self, level, zoom, item, x, y):
+        cell = self._cell(x, y, zoom)
+        cluster = level.get(cell)
+        if cluster is None:
+            cluster = level[cell] = Cluster(zoom)
+        cluster.add(item, x, y)
+
+    def _level(self, zoom):
+        level = self._levels.get(zoom)
+        if level is None:
+            level = self._levels[zoom] = {}
+            for item, (x, y) in self._points.iteritems():
+                self._place(level, zoom, item, x, y)
+        return level
+
+    def insert(self, item, point):
+        """
+        adds a marker, or moves it if it is already there
+
+        Args:
+            point (tuple): (x, y) of the marker in pixels of zoom 0
+        """
+        if item in self._points:
+            self.remove(item)
+        x, y = point
+        self._points[item] = (x, y)
+        for zoom, level in self._levels.iteritems():
+            self._place(level, zoom, item, x, y)
+
+    def insert_many(self, items):
+        """
+        Args:
+            items (iterator): (marker, point) pairs
+        """
+        for item, point in items:
+            self.insert(item, point)
+
+    def remove(self, item):
+        x, y = self._points.pop(item)
+        for zoom, level in self._levels.iteritems():
+            cell = self._cell(x, y, zoom)
+            cluster = level[cell]
+            cluster.remove(item, x, y)
+            if not cluster.items:
+                del level[cell]
+
+    def clear(self):
+        self._points = {}
+        self._levels = {}
+
+    def query(self, zoom, box):
+        """
+        Args:
+            box (tuple): (minx, miny, maxx, maxy) in pixels of zoom 0
+
+        Returns:
+            list.  the markers alone in their cell and the Clusters of the
+            others, in the cells touching box
+        """
+        level = self._level(zoom)
+        mincol, minrow = self._cell(box[0], box[1], zoom)
+        maxcol, maxrow = self._cell(box[2], box[3], zoom)
+        if (maxcol - mincol + 1) * (maxrow - minrow + 1) > len(level):
+            cells = [cell for cell in level
+                    if mincol <= cell[0] <= maxcol and
+                    minrow <= cell[1] <= maxrow]
+        else:
+            cells = [(col, row) for col in range(mincol, maxcol + 1)
+                    for row in range(minrow, maxrow + 1)
+                    if (col, row) in level]
+        result = []
+        for cell in cells:
+            cluster = level[cell]
+            if len(cluster) == 1:
+                result.extend(cluster.items)
+            else:
+                result.append(cluster)
+        return result
@@ -0,0 +1,831 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    This file is part of wxpymaps.
+#
+#    wxpymaps is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    wxpymaps is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with wxpymaps.  If not, see <http://www.gnu.org/licenses/>.
+
+"""tile download over persistent http connections, does not need wx"""
+
+import re
+import sys
+import time
+import heapq
+import Queue
+import random
+import thread
+import socket
+import httplib
+import asyncore
+import logging
+import itertools
+import threading
+import urlparse
+
+baseurlmap = {0: "http://mt1.google.com/vt/lyrs=m@132&hl=en",  # default
+    1: "http://mt1.google.com/vt/lyrs=t",
+    2: "http://mt1.google.com/vt/lyrs=p",
+
+    # mappe satellitari
+    3: "http://mt1.google.com/vt/lyrs=s",
+
+    # mappe satellitari con strade
+    4: "http://mt1.google.com/vt/lyrs=y",
+
+    # overlay:
+    5: "http://mt1.google.com/vt/lyrs=h",
+    6: "http://mt1.google.com/vt/lyrs=r"
+}
+
+#nomi dei tipi di mappa mostrati all'utente
+mapnames = {0: "Road", 1: "Terrain", 2: "Terrain with roads",
+    3: "Satellite", 4: "Hybrid", 5: "Labels", 6: "Roads"}
+basemaps = (0, 1, 2, 3, 4)
+overlays = (5, 6)  # immagini trasparenti da disegnare sopra una mappa
+
+TILE_SHARDS = 4  # i server mt0 - mt3 servono le stesse tile
+POOL_SIZE = 4  # connessioni inattive tenute aperte per ogni host
+DOWNLOAD_TIMEOUT = 10  # secondi
+ASYNC_CONCURRENCY = 64  # download contemporanei del motore asincrono
+ASYNC_PER_HOST = 16  # download contemporanei per ogni host
+USER_AGENT = "wxpymaps"
+SCHEDULER_MARGIN = 2  # tile fuori dall'area visibile da scaricare comunque
+RETRY_BASE = 2  # secondi di attesa dopo il primo errore di rete su una tile
+RETRY_MAX = 300  # attesa massima dopo errori di rete ripetuti
+NEGATIVE_TTL = 3600  # secondi di attesa per le tile che il server non ha
+NEGATIVE_CACHE_SIZE = 10000
+
+# risposte che non cambieranno riprovando
+PERMANENT_STATUS = (400, 404, 410)
+
+# host del tipo mt1.google.com, che possono essere distribuiti su mt0 - mt3
+_shard_re = re.compile(r"^mt\d+\.")
+
+
+def tile_url(map_type, x, y, zoom):
+    """
+    builds the url of a tile, spreading the tiles over the TILE_SHARDS
+    servers when the host supports it
+
+    Returns:
+        str.  the url of the tile
+    """
+    url = baseurlmap[map_type] + "&x=%d&y=%d&z=%d" % (x, y, zoom)
+    scheme, host, path, query, fragment = urlparse.urlsplit(url)
+    if TILE_SHARDS > 1 and _shard_re.match(host):
+        host = _shard_re.sub("mt%d." % ((x + 2 * y) % TILE_SHARDS), host)
+        url = urlparse.urlunsplit((scheme, host, path, query, fragment))
+    return url
+
+
+class ConnectionPool:
+    """
+    Keeps persistent (keep-alive) http connections to the tile servers,
+    shared by all the download threads
+    """
+
+    def __init__(self, maxsize=POOL_SIZE, timeout=DOWNLOAD_TIMEOUT):
+        """
+        Args:
+            maxsize (int): idle connections kept for each host
+            timeout (float): socket timeout in seconds
+        """
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, scheme, host):
+        if scheme == "https":
+            return httplib.HTTPSConnection(host, timeout=self.timeout)
+        return httplib.HTTPConnection(host, timeout=self.timeout)
+
+    def _get(self, scheme, host):
+        """
+        Returns:
+            tuple.  (connection, True if it was already open)
+        """
+        with self._lock:
+            idle = self._idle.get((scheme, host))
+            if idle:
+                return idle.pop(), True
+        return self._connect(scheme, host), False
+
+    def _release(self, scheme, host, conn):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, host), [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def fetch(self, url):
+        """
+        downloads url, reusing an open connection to its host if there is one
+
+        Returns:
+            tuple.  (http status, content type, body)
+
+        Raises:
+            IOError: when the server can not be reached
+        """
+        scheme, host, path, query, _ = urlparse.urlsplit(url)
+        if query:
+            path += "?" + query
+        headers = {"User-Agent": USER_AGENT, "Connection": "keep-alive"}
+        while True:
+            conn, reused = self._get(scheme, host)
+            try:
+                conn.request("GET", path, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                # il server puo' aver chiuso una connessione inattiva:
+                # riprovo una volta con una connessione nuova
+                if reused:
+                    logging.debug("stale connection to %s: %s", host, e)
+                    continue
+                raise IOError(e)
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(scheme, host, conn)
+            return (response.status, response.getheader("content-type", ""),
+                    data)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+def is_permanent(status):
+    """
+    Returns:
+        bool.  True if a download that got this http status should not be
+            retried soon
+    """
+    return status in PERMANENT_STATUS
+
+
+class NegativeCache:
+    """
+    Remembers the tiles whose download failed, so that they are not
+    requested again before their retry time. After network errors and
+    server errors the wait grows exponentially, with jitter; tiles the
+    server does not have wait NEGATIVE_TTL seconds.
+    """
+
+    def __init__(self, ttl=NEGATIVE_TTL, base=RETRY_BASE, maxdelay=RETRY_MAX,
+            maxsize=NEGATIVE_CACHE_SIZE):
+        self.ttl = ttl
+        self.base = base
+        self.maxdelay = maxdelay
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._failed = {}
+
+    def __len__(self):
+        return len(self._failed)
+
+    def failed(self, key, permanent=False):
+        """
+        records a failed download of the tile key
+        """
+        now = time.time()
+        with self._lock:
+            _, failures = self._failed.get(key, (now, 0))
+            failures += 1
+            if permanent:
+                delay = self.ttl
+            else:
+                delay = min(self.maxdelay, self.base * 2 ** (failures - 1))
+                delay = delay / 2.0 + random.uniform(0, delay / 2.0)
+            self._failed[key] = (now + delay, failures)
+            if len(self._failed) > self.maxsize:
+                self._prune(now)
+        logging.debug("tile %s failed %d times, retry in %.1fs", str(key),
+                failures, delay)
+
+    def succeeded(self, key):
+        with self._lock:
+            self._failed.pop(key, None)
+
+    def blocked(self, key):
+        """
+        Returns:
+            bool.  True if the tile key should not be requested yet
+        """
+        with self._lock:
+            entry = self._failed.get(key)
+        return entry is not None and entry[0] > time.time()
+
+    def _prune(self, now):
+        # dimentico le tile la cui attesa e' scaduta da un pezzo, poi se
+        # serve quelle che scadono prima
+        for key, (retry, _) in self._failed.items():
+            if retry + self.maxdelay < now:
+                del self._failed[key]
+        if len(self._failed) > self.maxsize:
+            keys = sorted(self._failed, key=lambda k: self._failed[k][0])
+            for key in keys[:len(keys) - self.maxsize]:
+                del self._failed[key]
+
+
+class RateLimiter:
+    """
+    Token bucket shared by several threads: on average at most rate units
+    (tiles, or bytes) per second, with bursts of at most burst units
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        Args:
+            rate (float): units per second, 0 for no limit
+            burst (float): bucket size, by default one second of rate
+        """
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst,
+                self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def wait(self, amount=1):
+        """
+        blocks until amount units can be used, and uses them
+        """
+        if not self.rate:
+            return
+        with self._lock:
+            self._refill(time.time())
+            self._tokens -= amount
+            delay = -self._tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+    def take(self, amount=1):
+        """
+        uses amount units if they are available, without blocking
+
+        Returns:
+            float.  0 if the units have been used, otherwise the seconds
+            to wait before they are available
+        """
+        if not self.rate:
+            return 0
+        with self._lock:
+            self._refill(time.time())
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return 0
+            return (amount - self._tokens) / self.rate
+
+
+class TileScheduler:
+    """
+    Queue of the tiles to download, served nearest to the center of the
+    viewport first. A tile already queued or downloading is not queued
+    again, and tiles of another zoom level or map type, or scrolled out of
+    view, are dropped instead of being downloaded. Tiles queued with
+    prefetch are served only when no visible tile is waiting, at most at
+    the rate allowed by limiter.
+    """
+
+    def __init__(self, margin=SCHEDULER_MARGIN, limiter=None):
+        """
+        Args:
+            margin (int): tiles around the viewport still worth downloading
+            limiter (RateLimiter): bandwidth budget of the prefetched tiles
+        """
+        self.margin = margin
+        self.limiter = limiter
+        self.zoom = None
+        self.window = None
+        self.center = None
+        self.layers = None
+        self.dropped = 0
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._inflight = set()
+        self._low = {}  # chiave -> ordine delle tile da prefetch
+        self._heap = []
+        self._seq = itertools.count()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._pending)
+
+    def set_viewport(self, zoom, window, center=None, layers=None):
+        """
+        moves the viewport: pending tiles that are no longer wanted are
+        dropped, the others are sorted again
+
+        Args:
+            zoom (int): current zoom level
+            window (tuple): (minx, miny, maxx, maxy) visible tiles, the max
+                values excluded
+            center (tuple): (x, y) center of the viewport in tile units,
+                by default the center of window
+            layers (list): map types shown, None for any
+        """
+        minx, miny, maxx, maxy = window
+        if center is None:
+            center = ((minx + maxx) / 2.0, (miny + maxy) / 2.0)
+        with self._cond:
+            self.zoom = zoom
+            self.window = (minx - self.margin, miny - self.margin,
+                    maxx + self.margin, maxy + self.margin)
+            self.center = center
+            self.layers = layers
+            # le tile da prefetch sono fuori dalla finestra, vengono
+            # sostituite alla prossima chiamata di prefetch
+            for key in [k for k in self._pending
+                    if k not in self._low and not self._wanted(k)]:
+                del self._pending[key]
+                self.dropped += 1
+            self._sort()
+
+    def _sort(self):
+        # le tile visibili (classe 0) prima di quelle da prefetch (classe 1)
+        self._heap = []
+        for key in self._pending:
+            if key in self._low:
+                entry = (1, self._low[key], next(self._seq), key)
+            else:
+                entry = (0, self._priority(key), next(self._seq), key)
+            self._heap.append(entry)
+        heapq.heapify(self._heap)
+
+    def _wanted(self, key):
+        x, y, zoom, map_type = key
+        if self.layers is not None and map_type not in self.layers:
+            return False
+        if self.zoom is None:
+            return True
+        minx, miny, maxx, maxy = self.window
+        return zoom == self.zoom and minx <= x < maxx and miny <= y < maxy
+
+    def _priority(self, key):
+        if self.center is None:
+            return 0
+        x, y = key[:2]
+        cx, cy = self.center
+        return (x + 0.5 - cx) ** 2 + (y + 0.5 - cy) ** 2
+
+    def put(self, item):
+        """
+        queues a tile, item.key is its (x, y, zoom, map_type) key
+
+        Returns:
+            bool.  False if the tile was not queued
+        """
+        return self.put_many([item]) == 1
+
+    def put_many(self, items):
+        """
+        queues a batch of tiles
+
+        Returns:
+            int.  number of tiles actually queued
+        """
+        queued = 0
+        with self._cond:
+            for item in items:
+                key = item.key
+                # se e' gia' in coda per il prefetch diventa urgente
+                promote = key in self._low
+                if not promote and (key in self._pending or
+                        key in self._inflight):
+                    continue
+                if not self._wanted(key):
+                    self.dropped += 1
+                    continue
+                if promote:
+                    del self._low[key]
+                self._pending[key] = item
+                heapq.heappush(self._heap,
+                        (0, self._priority(key), next(self._seq), key))
+                queued += 1
+            if queued:
+                self._cond.notify_all()
+        return queued
+
+    def prefetch(self, items):
+        """
+        replaces the tiles to download in advance: the prefetched tiles no
+        longer in items are dropped, the new ones queued with low priority
+
+        Args:
+            items (list): tiles in order of importance, the first ones
+                are downloaded first
+
+        Returns:
+            int.  number of tiles queued for prefetch
+        """
+        with self._cond:
+            for key in self._low.keys():
+                self._pending.pop(key, None)
+            self._low = {}
+            for item in items:
+                key = item.key
+                if (key in self._pending or key in self._inflight or
+                        key in self._low):
+                    continue
+                self._pending[key] = item
+                self._low[key] = len(self._low)
+            self._sort()
+            if self._low:
+                self._cond.notify_all()
+            return len(self._low)
+
+    def get(self, block=True, timeout=None):
+        """
+        takes the most urgent tile, like Queue.Queue.get
+
+        Raises:
+            Queue.Empty: if no tile is available
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                delay = None
+                while self._heap:
+                    level, _, _, key = self._heap[0]
+                    if key not in self._pending or (level == 1) != \
+                            (key in self._low):
+                        # gia' servita, o promossa da prefetch a visibile
+                        heapq.heappop(self._heap)
+                        continue
+                    if level == 1 and self.limiter is not None:
+                        delay = self.limiter.take()
+                        if delay > 0:
+                            break
+                    heapq.heappop(self._heap)
+                    item = self._pending.pop(key)
+                    self._low.pop(key, None)
+                    self._inflight.add(key)
+                    return item
+                if not block:
+                    raise Queue.Empty
+                if timeout is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Queue.Empty
+                    if delay is None or delay > remaining:
+                        delay = remaining
+                # una tile visibile messa in coda nel frattempo sveglia
+                # subito il thread
+                self._cond.wait(delay)
+
+    def task_done(self, item):
+        """
+        to be called when the download of item ends
+        """
+        with self._cond:
+            self._inflight.discard(item.key)
+
+
+class RequestBatcher:
+    """
+    Collects tile requests for a short while and submits them in a single
+    batch, so that a redraw costs no threads. Requests for the same tile in
+    the same batch are merged.
+    """
+
+    def __init__(self, submit, delay):
+        """
+        Args:
+            submit (function): called from the batcher thread with the
+                list of the requested tiles
+            delay (float): seconds a request waits for others to join it
+        """
+        self.submit = submit
+        self.delay = delay
+        self.keepGoing = True
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._deadline = None
+
+    def Start(self):
+        thread.start_new_thread(self.Run, ())
+
+    def Stop(self):
+        with self._cond:
+            self.keepGoing = False
+            self._cond.notify()
+
+    def add(self, item):
+        with self._cond:
+            if not self._pending:
+                self._deadline = time.time() + self.delay
+                self._cond.notify()
+            self._pending[item.key] = item
+
+    def Run(self):
+        while True:
+            with self._cond:
+                while self.keepGoing and not self._pending:
+                    self._cond.wait()
+                if not self.keepGoing:
+                    return
+                remaining = self._deadline - time.time()
+                while self.keepGoing and remaining > 0:
+                    self._cond.wait(remaining)
+                    remaining = self._deadline - time.time()
+                if not self.keepGoing:
+                    return
+                batch, self._pending = self._pending.values(), {}
+            try:
+                self.submit(batch)
+            except Exception:
+                logging.exception("tile batch submit failed")
+
+
+def _dechunk(data):
+    """
+    decodes a chunked http body
+
+    Returns:
+        str.  the body, or None if data does not contain it all yet
+    """
+    body = []
+    pos = 0
+    while True:
+        end = data.find("\r\n", pos)
+        if end < 0:
+            return None
+        size = int(data[pos:end].split(";")[0], 16)
+        pos = end + 2
+        if size == 0:
+            # ignoro gli eventuali trailer
+            if data.find("\r\n", pos) < 0:
+                return None
+            return "".join(body)
+        if len(data) < pos + size + 2:
+            return None
+        body.append(data[pos:pos + size])
+        pos += size + 2
+
+
+class _HTTPChannel(asyncore.dispatcher):
+    """
+    A non-blocking keep-alive connection to a tile server, used by
+    AsyncDownloader for one request at a time
+    """
+
+    def __init__(self, engine, host, addr):
+        asyncore.dispatcher.__init__(self, map=engine._map)
+        self.engine = engine
+        self.host = host
+        self.item = None
+        self.reused = False
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(addr)
+
+    def start(self, item, path, reused):
+        self.item = item
+        self.path = path
+        self.reused = reused
+        self.deadline = time.time() + self.engine.timeout
+        self.outbuf = ("GET %s HTTP/1.1\r\nHost: %s\r\nUser-Agent: %s\r\n"
+                "Connection: keep-alive\r\n\r\n" % (path, self.host,
+                        USER_AGENT))
+        self.inbuf = ""
+        self.status = None
+        self.headers = None
+
+    def writable(self):
+        return not self.connected or (self.item is not None and
+                bool(self.outbuf))
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self.outbuf)
+        self.outbuf = self.outbuf[sent:]
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if self.item is not None and data:
+            self.inbuf += data
+            self.parse(False)
+
+    def handle_close(self):
+        if self.item is None or not self.parse(True):
+            self.fail(IOError("connection closed by %s" % self.host))
+        self.engine._forget(self)
+
+    def handle_error(self):
+        self.fail(IOError(sys.exc_info()[1]))
+        self.engine._forget(self)
+
+    def parse(self, closed):
+        """
+        Returns:
+            bool.  True when the whole response has been received
+        """
+        if self.headers is None:
+            end = self.inbuf.find("\r\n\r\n")
+            if end < 0:
+                return False
+            lines = self.inbuf[:end].split("\r\n")
+            self.inbuf = self.inbuf[end + 4:]
+            version, status = lines[0].split(None, 2)[:2]
+            self.status = int(status)
+            self.headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(":")
+                self.headers[name.strip().lower()] = value.strip()
+            self.keepalive = (version == "HTTP/1.1" and
+                    self.headers.get("connection", "").lower() != "close")
+            if self.status < 200:
+                # risposta intermedia (100 continue), aspetto quella vera
+                self.headers = None
+                return self.parse(closed)
+        if "chunked" in self.headers.get("transfer-encoding", "").lower():
+            body = _dechunk(self.inbuf)
+        elif "content-length" in self.headers:
+            length = int(self.headers["content-length"])
+            body = self.inbuf[:length] if len(self.inbuf) >= length else None
+        else:
+            self.keepalive = False
+            body = self.inbuf if closed else None
+        if body is None:
+            return False
+        item, self.item = self.item, None
+        self.engine._done(self, item, (self.status,
+                self.headers.get("content-type", ""), body))
+        return True
+
+    def fail(self, error):
+        if self.item is None:
+            return
+        item, self.item = self.item, None
+        self.keepalive = False
+        if self.reused and self.headers is None and not self.inbuf:
+            # connessione inattiva chiusa dal server: riprovo su una nuova
+            logging.debug("stale connection to %s: %s", self.host, error)
+            self.engine._retry(self, item, self.path)
+        else:
+            logging.debug("download from %s failed: %s", self.host, error)
+            self.engine._done(self, item, None)
+
+
+class AsyncDownloader:
+    """
+    Downloads many tiles concurrently from a single thread, driving
+    non-blocking keep-alive connections with asyncore
+    """
+
+    def __init__(self, jobs, geturl, callback, concurrency=ASYNC_CONCURRENCY,
+            per_host=ASYNC_PER_HOST, timeout=DOWNLOAD_TIMEOUT):
+        """
+        Args:
+            jobs (TileScheduler): items to download
+            geturl (function): returns the url of an item
+            callback (function): called from the download thread as
+                callback(item, response) for every item; response is
+                (http status, content type, body), or None on network errors
+            concurrency (int): max downloads in flight
+            per_host (int): max downloads in flight for each host
+            timeout (float): seconds allowed for each download
+        """
+        self.jobs = jobs
+        self.geturl = geturl
+        self.callback = callback
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.timeout = timeout
+        self.keepGoing = True
+        self.inflight = 0
+        self._map = {}
+        self._idle = {}
+        self._active = {}
+        self._waiting = []
+        self._addrs = {}
+
+    def Start(self):
+        thread.start_new_thread(self.Run, ())
+
+    def Stop(self):
+        self.keepGoing = False
+
+    def Run(self):
+        while self.keepGoing:
+            self._fill()
+            if self._map:
+                asyncore.loop(timeout=0.05, map=self._map, count=1)
+            self._expire()
+        for channel in self._map.values():
+            channel.close()
+
+    def _fill(self):
+        """
+        starts new downloads until the concurrency limits are reached
+        """
+        waiting, self._waiting = self._waiting, []
+        for url, item in waiting:
+            self._start(url, item)
+        while self.inflight + len(self._waiting) < self.concurrency:
+            # se non c'e' niente in corso aspetto un nuovo job
+            idle = self.inflight == 0 and not self._waiting
+            try:
+                item = self.jobs.get(idle, 0.5)
+            except Queue.Empty:
+                return
+            self._start(self.geturl(item), item)
+
+    def _start(self, url, item, reuse=True):
+        scheme, host, path, query, _ = urlparse.urlsplit(url)
+        if query:
+            path += "?" + query
+        if scheme != "http":
+            logging.error("unsupported url %s", url)
+            self._finish(item, None)
+            return
+        if self._active.get(host, 0) >= self.per_host:
+            self._waiting.append((url, item))
+            return
+        idle = self._idle.get(host)
+        reused = bool(idle) and reuse
+        if reused:
+            channel = idle.pop()
+        else:
+            try:
+                channel = _HTTPChannel(self, host, self._resolve(host))
+            except (socket.error, ValueError) as e:
+                logging.debug("can't connect to %s: %s", host, e)
+                self._finish(item, None)
+                return
+        self._active[host] = self._active.get(host, 0) + 1
+        self.inflight += 1
+        channel.start(item, path, reused)
+
+    def _resolve(self, host):
+        # la risoluzione dns e' bloccante, la faccio una sola volta per host
+        if host not in self._addrs:
+            hostname, _, port = host.partition(":")
+            self._addrs[host] = (socket.gethostbyname(hostname),
+                    int(port or 80))
+        return self._addrs[host]
+
+    def _release(self, channel):
+        self._active[channel.host] -= 1
+        self.inflight -= 1
+
+    def _done(self, channel, item, response):
+        self._release(channel)
+        if channel.keepalive:
+            self._idle.setdefault(channel.host, []).append(channel)
+        else:
+            self._forget(channel)
+            channel.close()
+        self._finish(item, response)
+
+    def _retry(self, channel, item, path):
+        self._release(channel)
+        self._forget(channel)
+        channel.close()
+        self._start("http://" + channel.host + path, item, reuse=False)
+
+    def _forget(self, channel):
+        idle = self._idle.get(channel.host, [])
+        if channel in idle:
+            idle.remove(channel)
+        if channel.item is None:
+            channel.close()
+
+    def _finish(self, item, response):
+        try:
+            self.callback(item, response)
+        except Exception:
+            logging.exception("download callback failed")
+        self.jobs.task_done(item)
+
+    def _expire(self):
+        now = time.time()
+        for channel in self._map.values():
+            if channel.item is not None and channel.deadline < now:
+                channel.fail(IOError("timeout"))
+                self._forget(channel)
@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    This file is part of wxpymaps.
+#
+#    wxpymaps is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    wxpymaps is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with wxpymaps.  If not, see <http://www.gnu.org/licenses/>.
+
+"""plane geometry on map coordinates, does not need wx"""
+
+import math
+
+INDEX_CELL = 256.0  # lato delle celle dell'indice dello zoom 0: una tile
+INDEX_MAX_CELLS = 1024  # celle oltre le quali un oggetto non va nella griglia
+INDEX_MAX_LEVEL = 22  # ultimo zoom con una griglia propria
+
+
+def polygon_tiles(ring):
+    """
+    finds the cells of the unit grid touched by a polygon, one row at a
+    time: a cell is touched if an edge crosses it or if it lies inside
+
+    Args:
+        ring (list): (x, y) vertices of the polygon, in grid units (tiles)
+
+    Returns:
+        iterator.  the (x, y) of the touched cells
+    """
+    if not ring:
+        return
+    edges = zip(ring, ring[1:] + ring[:1])
+    ys = [y for _, y in ring]
+    for row in range(int(math.floor(min(ys))),
+            int(math.floor(max(ys))) + 1):
+        top, bottom = row, row + 1
+        spans = []
+        for (x1, y1), (x2, y2) in edges:
+            # parte del lato che cade nella riga
+            if max(y1, y2) < top or min(y1, y2) > bottom:
+                continue
+            if y1 == y2:
+                spans.append((min(x1, x2), max(x1, x2)))
+                continue
+            t1 = min(max((top - y1) / float(y2 - y1), 0.0), 1.0)
+            t2 = min(max((bottom - y1) / float(y2 - y1), 0.0), 1.0)
+            xa = x1 + (x2 - x1) * t1
+            xb = x1 + (x2 - x1) * t2
+            spans.append((min(xa, xb), max(xa, xb)))
+        # celle interne: intersezioni del bordo con la linea di mezzo
+        middle = row + 0.5
+        xs = sorted(x1 + (middle - y1) * (x2 - x1) / float(y2 - y1)
+                for (x1, y1), (x2, y2) in edges
+                if (y1 <= middle) != (y2 <= middle))
+        spans.extend(zip(xs[0::2], xs[1::2]))
+        cols = set()
+        for xa, xb in spans:
+            cols.update(range(int(math.floor(xa)), int(math.floor(xb)) + 1))
+        for col in sorted(cols):
+            yield col, row
+
+
+def point_segment_distance(px, py, x1, y1, x2, y2):
+    """
+    Returns:
+        float.  distance of the point (px, py) from the segment
+    """
+    dx = x2 - x1
+    dy = y2 - y1
+    if dx == 0 and dy == 0:
+        return math.hypot(px - x1, py - y1)
+    t = ((px - x1) * dx + (py - y1) * dy) / float(dx * dx + dy * dy)
+    t = min(max(t, 0.0), 1.0)
+    return math.hypot(px - (x1 + t * dx), py - (y1 + t * dy))
+
+
+def segment_rect_distance(x1, y1, x2, y2, rect):
+    """
+    Args:
+        rect (tuple): (minx, miny, maxx, maxy)
+
+    Returns:
+        float.  distance between the segment and the rectangle, 0 if they
+            touch
+    """
+    minx, miny, maxx, maxy = rect
+    # ritaglio il segmento sul rettangolo (Liang-Barsky)
+    t0, t1 = 0.0, 1.0
+    dx = x2 - x1
+    dy = y2 - y1
+    for p, q in ((-dx, x1 - minx), (dx, maxx - x1),
+            (-dy, y1 - miny), (dy, maxy - y1)):
+        if p == 0:
+            if q < 0:
+                break
+        else:
+            t = q / float(p)
+            if p < 0:
+                t0 = max(t0, t)
+            else:
+                t1 = min(t1, t)
+    else:
+        if t0 <= t1:
+            return 0.0
+    corners = ((minx, miny), (maxx, miny), (minx, maxy), (maxx, maxy))
+    ends = ((x1, y1), (x2, y2))
+    return min([point_segment_distance(cx, cy, x1, y1, x2, y2)
+            for cx, cy in corners] +
+            [math.hypot(max(minx - ex, 0, ex - maxx),
+                    max(miny - ey, 0, ey - maxy)) for ex, ey in ends])
+
+
+def corridor_tiles(path, buffer):
+    """
+    finds the cells of the unit grid within buffer of a polyline; long
+    segments are walked one cell at a time, so the work grows with the
+    length of the path and not with its bounding box
+
+    Args:
+        path (list): (x, y) vertices in grid units (tiles); a single vertex
+            gives the cells around a point
+        buffer (float): distance in grid units
+
+    Returns:
+        iterator.  the (x, y) of the cells, without duplicates
+    """
+    seen = set()
+    if len(path) == 1:
+        path = path * 2
+    for (ax, ay), (bx, by) in zip(path, path[1:]):
+        steps = max(int(math.ceil(math.hypot(bx - ax, by - ay))), 1)
+        for i in range(steps):
+            x1 = ax + (bx - ax) * i / float(steps)
+            y1 = ay + (by - ay) * i / float(steps)
+            x2 = ax + (bx - ax) * (i + 1) / float(steps)
+            y2 = ay + (by - ay) * (i + 1) / float(steps)
+            for col in range(int(math.floor(min(x1, x2) - buffer)),
+                    int(math.floor(max(x1, x2) + buffer)) + 1):
+                for row in range(int(math.floor(min(y1, y2) - buffer)),
+                        int(math.floor(max(y1, y2) + buffer)) + 1):
+                    if (col, row) in seen:
+                        continue
+                    if segment_rect_distance(x1, y1, x2, y2,
+                            (col, row, col + 1, row + 1)) <= buffer:
+                        seen.add((col, row))
+                        yield col, row
+
+
+def simplify_weights(points):
+    """
+    runs Douglas-Peucker once for every tolerance: each vertex gets the
+    largest tolerance at which it is still kept, so the simplification
+    with tolerance t are the vertices whose weight is at least t. The
+    polyline is split with a stack, long tracks do not hit the recursion
+    limit.
+
+    Args:
+        points (list): (x, y) vertices of the polyline
+
+    Returns:
+        list.  the weight of each vertex, infinite for the ends
+    """
+    n = len(points)
+    weights = [0.0] * n
+    if n == 0:
+        return weights
+    weights[0] = weights[-1] = float("inf")
+    stack = [(0, n - 1, float("inf"))]
+    while stack:
+        first, last, limit = stack.pop()
+        if last - first < 2:
+            continue
+        x1, y1 = points[first]
+        x2, y2 = points[last]
+        dx = x2 - x1
+        dy = y2 - y1
+        length = float(dx * dx + dy * dy)
+        best = -1.0
+        index = first + 1
+        # come point_segment_distance, ma al quadrato e senza chiamate: e'
+        # il ciclo piu' lungo
+        for i in xrange(first + 1, last):
+            px, py = points[i]
+            ex = px - x1
+            ey = py - y1
+            if length:
+                t = (ex * dx + ey * dy) / length
+                if t > 1.0:
+                    t = 1.0
+                elif t < 0.0:
+                    t = 0.0
+                ex -= t * dx
+                ey -= t * dy
+            d = ex * ex + ey * ey
+            if d > best:
+                best = d
+                index = i
+        best = math.sqrt(best)
+        # un vertice non pesa piu' di quello che ha diviso il suo tratto,
+        # altrimenti resterebbe senza il vertice da cui dipende
+        best = min(best, limit)
+        weights[index] = best
+        stack.append((first, index, best))
+        stack.append((index, last, best))
+    return weights
+
+
+def simplify(weights, tolerance):
+    """
+    Args:
+        weights (list): of the vertices, as returned by simplify_weights
+        tolerance (float): max distance of the dropped vertices from the
+            simplified polyline
+
+    Returns:
+        list.  the indexes of the vertices kept
+    """
+    return [i for i, w in enumerate(weights) if w >= tolerance]
+
+
+class GridIndex:
+    """
+    Spatial index of items with a bounding box, kept in the cells of a
+    regular grid; an item is listed in every cell its box touches, items
+    touching more than maxcells cells are kept apart and always checked.
+    Boxes are (minx, miny, maxx, maxy) in any plane unit, e.g. the pixels
+    of zoom 0.
+    """
+
+    def __init__(self, cellsize=INDEX_CELL, maxcells=INDEX_MAX_CELLS):
+        """
+        Args:
+            cellsize (float): side of a cell, in the units of the boxes
+            maxcells (int): cells above which an item is not gridded
+        """
+        self.cellsize = float(cellsize)
+        self.maxcells = maxcells
+        self._cells = {}
+        self._boxes = {}
+        self._big = set()
+
+    def __len__(self):
+        return len(self._boxes)
+
+    def __contains__(self, item):
+        return item in self._boxes
+
+    def _range(self, box):
+        minx, miny, maxx, maxy = box
+        size = self.cellsize
+        return (int(math.floor(minx / size)), int(math.floor(miny / size)),
+                int(math.floor(maxx / size)), int(math.floor(maxy / size)))
+
+    def insert(self, item, box):
+        """
+        adds item, or moves it if it is already in the index
+        """
+        if item in self._boxes:
+            self.remove(item)
+        self._boxes[item] = box
+        cx1, cy1, cx2, cy2 = self._range(box)
+        if (cx2 - cx1 + 1) * (cy2 - cy1 + 1) > self.maxcells:
+            self._big.add(item)
+            return
+        cells = self._cells
+        for cx in range(cx1, cx2 + 1):
+            for cy in range(cy1, cy2 + 1):
+                cell = cells.get((cx, cy))
+                if cell is None:
+                    cells[(cx, cy)] = cell = []
+                cell.append(item)
+
+    def insert_many(self, items):
+        """
+        adds many items in a single pass
+
+        Args:
+            items (iterable): (item, box) pairs
+        """
+        for item, box in items:
+            self.insert(item, box)
+
+    def remove(self, item):
+        box = self._boxes.pop(item, None)
+        if box is None:
+            return
+        if item in self._big:
+            self._big.discard(item)
+            return
+        cx1, cy1, cx2, cy2 = self._range(box)
+        for cx in range(cx1, cx2 + 1):
+            for cy in range(cy1, cy2 + 1):
+                cell = self._cells.get((cx, cy))
+                if cell is not None:
+                    cell.remove(item)
+                    if not cell:
+                        del self._cells[(cx, cy)]
+
+    def clear(self):
+        self._cells.clear()
+        self._boxes.clear()
+        self._big.clear()
+
+    def bounds(self, item):
+        """
+        Returns:
+            tuple.  the box of item, None if it is not in the index
+        """
+        return self._boxes.get(item)
+
+    def query(self, box):
+        """
+        Returns:
+            list.  the items whose box intersects box
+        """
+        minx, miny, maxx, maxy = box
+        boxes = self._boxes
+        found = set()
+        result = []
+
+        def check(item):
+            if item in found:
+                return
+            found.add(item)
+            ix1, iy1, ix2, iy2 = boxes[item]
+            if ix1 <= maxx and ix2 >= minx and iy1 <= maxy and iy2 >= miny:
+                result.append(item)
+
+        cx1, cy1, cx2, cy2 = self._range(box)
+        if (cx2 - cx1 + 1) * (cy2 - cy1 + 1) > len(self._cells):
+            # area piu' grande dell'indice: faccio prima a scorrere tutto
+            for item in boxes:
+                check(item)
+            return result
+        for cx in range(cx1, cx2 + 1):
+            for cy in range(cy1, cy2 + 1):
+                for item in self._cells.get((cx, cy), ()):
+                    check(item)
+        for item in self._big:
+            check(item)
+        return result
+
+
+class MultiGridIndex:
+    """
+    Spatial index with a GridIndex for each zoom level, whose cells are as
+    large as a tile of that level: the boxes are in pixels of zoom 0, and
+    a query of the visible area checks a few cells at any zoom. A level is
+    built the first time it is queried and then kept up to date by insert
+    and remove.
+    """
+
+    def __init__(self, cellsize=INDEX_CELL, maxcells=INDEX_MAX_CELLS,
+            maxlevel=INDEX_MAX_LEVEL):
+        """
+        Args:
+            cellsize (float): side of the cells of level 0, halved at each
+                level
+            maxcells (int): cells above which an item is not gridded
+            maxlevel (int): deepest level, deeper queries use it
+        """
+        self.cellsize = float(cellsize)
+        self.maxcells = maxcells
+        self.maxlevel = maxlevel
+        self._boxes = {}
+        self._levels = {}  # livello -> GridIndex
+
+    def __len__(self):
+        return len(self._boxes)
+
+    def __contains__(self, item):
+        return item in self._boxes
+
+    def _level(self, level):
+        level = min(max(int(level), 0), self.maxlevel)
+        grid = self._levels.get(level)
+        if grid is None:
+            grid = GridIndex(self.cellsize / 2 ** level, self.maxcells)
+            grid.insert_many(self._boxes.iteritems())
+            self._levels[level] = grid
+        return grid
+
+    def insert(self, item, box):
+        """
+        adds item, or moves it if it is already in the index
+        """
+        self._boxes[item] = box
+        for grid in self._levels.itervalues():
+            grid.insert(item, box)
+
+    def insert_many(self, items):
+        """
+        Args:
+            items (iterable): (item, box) pairs
+        """
+        for item, box in items:
+            self.insert(item, box)
+
+    def remove(self, item):
+        if self._boxes.pop(item, None) is None:
+            return
+        for grid in self._levels.itervalues():
+            grid.remove(item)
+
+    def clear(self):
+        self._boxes.clear()
+        self._levels.clear()
+
+    def bounds(self, item):
+        """
+        Returns:
+            tuple.  the box of item, None if it is not in the index
+        """
+        return self._boxes.get(item)
+
+    def query(self, box, zoom=0):
+        """
+        Args:
+            zoom (int): the zoom level the box is shown at, it chooses the
+                grid to use
+
+        Returns:
+            list.  the items whose box intersects box
+        """
+        return self._level(zoom).query(box)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    This file is part of wxpymaps.
+#
+#    wxpymaps is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    wxpymaps is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with wxpymaps.  If not, see <http://www.gnu.org/licenses/>.
+
+"""reads the geometries of kml files, does not need wx"""
+
+import logging
+import xml.dom.minidom
+
+
+def _text(node):
+    return "".join(n.data for n in node.childNodes
+            if n.nodeType in (n.TEXT_NODE, n.CDATA_SECTION_NODE))
+
+
+def parse_coordinates(text):
+    """
+    parses the content of a kml <coordinates> element, "lon,lat[,alt]"
+    tuples separated by spaces or newlines
+
+    Returns:
+        list.  (lat, lon) points
+    """
+    path = []
+    for p in text.split():
+        lon, lat = p.split(",")[:2]
+        path.append((float(lat), float(lon)))
+    return path
+
+
+def parse_kml(namefile):
+    """
+    reads the placemarks of a kml file
+
+    Returns:
+        list.  (kind, name, description, points) tuples, where kind is
+            "point", "linestring" or "polygon" (its outer boundary) and
+            points is a list of (lat, lon)
+    """
+    placemarks = []
+    doc = xml.dom.minidom.parse(namefile)
+    for node in doc.getElementsByTagName("Placemark"):
+        p_name = ""
+        for name in node.getElementsByTagName("name"):
+            p_name = _text(name).encode('utf8')
+            logging.debug("p_name=%s", str(p_name))
+
+        p_description = ""
+        for desc in node.getElementsByTagName("description"):
+            p_description = _text(desc).encode('utf8')
+            logging.debug("p_description=%s", str(p_description))
+
+        for point in node.getElementsByTagName("Point"):
+            for coordinates in point.getElementsByTagName("coordinates"):
+                for p in parse_coordinates(_text(coordinates)):
+                    placemarks.append(("point", p_name, p_description, [p]))
+
+        for linestring in node.getElementsByTagName("LineString"):
+            path = []
+            for coordinates in linestring.getElementsByTagName("coordinates"):
+                path.extend(parse_coordinates(_text(coordinates)))
+            placemarks.append(("linestring", p_name, p_description, path))
+
+        for polygon in node.getElementsByTagName("Polygon"):
+            for outer in polygon.getElementsByTagName("outerBoundaryIs"):
+                ring = []
+                for coordinates in outer.getElementsByTagName("coordinates"):
+                    ring.extend(parse_coordinates(_text(coordinates)))
+                placemarks.append(("polygon", p_name, p_description, ring))
+    return placemarks
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    This file is part of wxpymaps.
+#
+#    wxpymaps is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    wxpymaps is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with wxpymaps.  If not, see <http://www.gnu.org/licenses/>.
+
+"""guesses the tiles that will be shown soon, does not need wx"""
+
+import math
+import time
+
+PREFETCH_LOOKAHEAD = 1.5  # secondi di movimento da anticipare
+PREFETCH_MAX_SHIFT = 4  # tile massime di anticipo nella direzione del pan
+PAN_SMOOTHING = 0.5  # peso dell'ultimo spostamento nella velocita'
+PAN_TIMEOUT = 2  # secondi senza spostamenti dopo cui la vista e' ferma
+MAX_ZOOM = 22
+
+
+def window(center, size, zoom):
+    """
+    Returns:
+        tuple.  (minx, miny, maxx, maxy) tiles of a view of size (width,
+        height) tiles centered in center, the max values excluded
+    """
+    last = 2 ** zoom
+    cx, cy = center
+    w, h = size
+    return (max(int(math.floor(cx - w / 2.0)), 0),
+            max(int(math.floor(cy - h / 2.0)), 0),
+            min(int(math.ceil(cx + w / 2.0)), last),
+            min(int(math.ceil(cy + h / 2.0)), last))
+
+
+def nearest(rect, center, zoom, exclude=None):
+    """
+    Returns:
+        list.  the (x, y, zoom) tiles of rect not in exclude, nearest to
+        center first
+    """
+    minx, miny, maxx, maxy = rect
+    cx, cy = center
+    tiles = []
+    for x in range(minx, maxx):
+        for y in range(miny, maxy):
+            if exclude is not None:
+                ex1, ey1, ex2, ey2 = exclude
+                if ex1 <= x < ex2 and ey1 <= y < ey2:
+                    continue
+            tiles.append(((x + 0.5 - cx) ** 2 + (y + 0.5 - cy) ** 2,
+                    (x, y, zoom)))
+    tiles.sort()
+    return [tile for _, tile in tiles]
+
+
+class Prefetcher:
+    """
+    Follows the movements of the view and guesses the tiles that will be
+    shown soon: those ahead in the direction of the pan, at its speed, and
+    those of the next zoom level (the previous one after a zoom out)
+    around the pointer.
+    """
+
+    def __init__(self, lookahead=PREFETCH_LOOKAHEAD,
+            maxshift=PREFETCH_MAX_SHIFT):
+        """
+        Args:
+            lookahead (float): seconds of movement to anticipate
+            maxshift (float): max tiles to anticipate in the pan direction
+        """
+        self.lookahead = lookahead
+        self.maxshift = maxshift
+        self.zoom = None
+        self.center = None
+        self.size = (0, 0)
+        self.velocity = (0.0, 0.0)
+        self.last = 0
+        self.zoomdir = 1
+        self.pointer = None
+
+    def moved(self, zoom, center, size, now=None):
+        """
+        records a new position of the view
+
+        Args:
+            zoom (int): zoom level
+            center (tuple): (x, y) center of the view in tile units
+            size (tuple): (width, height) of the view in tiles
+        """
+        now = now or time.time()
+        if (zoom != self.zoom or self.center is None or
+                now - self.last > PAN_TIMEOUT):
+            self.velocity = (0.0, 0.0)
+        else:
+            dt = max(now - self.last, 0.05)
+            a = PAN_SMOOTHING
+            self.velocity = tuple(a * (new - old) / dt + (1 - a) * v
+                    for new, old, v in zip(center, self.center,
+                    self.velocity))
+        self.zoom = zoom
+        self.center = center
+        self.size = size
+        self.last = now
+
+    def zoomed(self, direction):
+        """
+        records a zoom in (direction 1) or out (direction -1)
+        """
+        self.zoomdir = direction
+
+    def pointed(self, x, y, zoom):
+        """
+        records the position of the mouse, in tile units
+        """
+        self.pointer = (x, y, zoom)
+
+    def tiles(self, now=None):
+        """
+        Returns:
+            list.  the (x, y, zoom) tiles to download in advance, the most
+            likely to be shown first; the visible ones are excluded
+        """
+        if self.center is None:
+            return []
+        now = now or time.time()
+        zoom = self.zoom
+        cx, cy = self.center
+        visible = window(self.center, self.size, zoom)
+        result = []
+        if now - self.last <= PAN_TIMEOUT:
+            dx, dy = [max(-self.maxshift, min(self.maxshift,
+                    v * self.lookahead)) for v in self.velocity]
+            if abs(dx) >= 0.5 or abs(dy) >= 0.5:
+                ahead = (cx + dx, cy + dy)
+                result.extend(nearest(window(ahead, self.size, zoom), ahead,
+                        zoom, visible))
+        newzoom = zoom + self.zoomdir
+        if 0 <= newzoom <= MAX_ZOOM:
+            focus = self.center
+            if self.pointer is not None and self.pointer[2] == zoom:
+                px, py, _ = self.pointer
+                if (visible[0] <= px < visible[2] and
+                        visible[1] <= py < visible[3]):
+                    focus = (px, py)
+            scale = 2.0 ** self.zoomdir
+            focus = (focus[0] * scale, focus[1] * scale)
+            result.extend(nearest(window(focus, self.size, newzoom), focus,
+                    newzoom))
+        return result
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    This file is part of wxpymaps.
+#
+#    wxpymaps is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    wxpymaps is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with wxpymaps.  If not, see <http://www.gnu.org/licenses/>.
+
+"""conversion between (lat, lon) and map pixels, does not need wx"""
+
+import math
+
+import globalmaptiles
+
+# numpy e' facoltativo: converte migliaia di punti in una sola operazione
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def tolist(values):
+    """
+    Returns:
+        list.  values, a numpy array or a sequence, as a list of python
+        numbers, faster than numpy scalars when used one at a time
+    """
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        return values.tolist()
+    return list(values)
+
+
+class MyMercator(globalmaptiles.GlobalMercator):
+    """
+    Estendo  la classe GlobalMercator, creando i due metodi che userò
+    nell'applicazione
+    """
+
+    def __init__(object):
+        globalmaptiles.GlobalMercator.__init__(object)
+
+    def pixels_to_lat_lon(self, x, y, zoom):
+        """
+        converte le coordinate da pixel a (lat, lon) per un certo zoom
+        """
+        mx, my = self.PixelsToMeters(x, y, zoom)
+        lat, lon = self.MetersToLatLon(mx, my)
+        #lat corretto
+        return -lat, lon
+
+    def lat_lon_to_pixels(self, lat, lon, zoom):
+        """
+        converte le coordinate da (lat, lon) a pixel per un certo zoom
+        """
+        mx, my = self.LatLonToMeters(lat, lon)
+        x, y = self.MetersToPixels(mx, my, zoom)
+        #correzione coordinata y (globalmaptiles ha l'origine sull'orizzonte, \
+        #python in alto a sinistra)
+        y = ((2 ** zoom) * 256) - y
+        return x, y
+
+    def lat_lon_to_pixels_many(self, lats, lons, zoom):
+        """
+        converts many points at once, like lat_lon_to_pixels; with numpy
+        the conversion is vectorized
+
+        Args:
+            lats (list): latitudes
+            lons (list): longitudes, as many as lats
+
+        Returns:
+            tuple.  (xs, ys) pixels, numpy arrays if numpy is installed,
+            otherwise lists
+        """
+        res = self.Resolution(zoom)
+        shift = self.originShift
+        size = (2 ** zoom) * 256
+        if numpy is not None:
+            lats = numpy.asarray(lats, dtype=float)
+            lons = numpy.asarray(lons, dtype=float)
+            mx = lons * shift / 180.0
+            my = numpy.log(numpy.tan((90 + lats) * math.pi / 360.0)) \
+                    / (math.pi / 180.0) * shift / 180.0
+            return (mx + shift) / res, size - (my + shift) / res
+        xs = []
+        ys = []
+        for lat, lon in zip(lats, lons):
+            mx, my = self.LatLonToMeters(float(lat), float(lon))
+            xs.append((mx + shift) / res)
+            ys.append(size - (my + shift) / res)
+        return xs, ys
+
+    def pixels_to_lat_lon_many(self, xs, ys, zoom):
+        """
+        converts many pixels at once, like pixels_to_lat_lon
+
+        Returns:
+            tuple.  (lats, lons), numpy arrays if numpy is installed,
+            otherwise lists
+        """
+        res = self.Resolution(zoom)
+        shift = self.originShift
+        if numpy is not None:
+            xs = numpy.asarray(xs, dtype=float)
+            ys = numpy.asarray(ys, dtype=float)
+            lons = (xs * res - shift) / shift * 180.0
+            lats = (ys * res - shift) / shift * 180.0
+            lats = 180 / math.pi * (2 * numpy.arctan(numpy.exp(
+                    lats * math.pi / 180.0)) - math.pi / 2.0)
+            return -lats, lons
+        lats = []
+        lons = []
+        for x, y in zip(xs, ys):
+            lat, lon = self.pixels_to_lat_lon(x, y, zoom)
+            lats.append(lat)
+            lons.append(lon)
+        return lats, lons
+
+    def scale(self, xs, ys, zoom):
+        """
+        scales pixels of zoom 0, as returned by lat_lon_to_pixels_many, to
+        zoom; the pixels of each zoom are those of zoom 0 times 2 ** zoom
+
+        Returns:
+            list.  the (x, y) pixels at zoom
+        """
+        factor = 2 ** zoom
+        if numpy is not None:
+            xs = numpy.asarray(xs, dtype=float) * factor
+            ys = numpy.asarray(ys, dtype=float) * factor
+            return zip(xs.tolist(), ys.tolist())
+        return [(x * factor, y * factor) for x, y in zip(xs, ys)]
+
+mercator = MyMercator()
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    This file is part of wxpymaps.
+#
+#    wxpymaps is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    wxpymaps is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with wxpymaps.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+downloads the tiles of a region into the offline cache, without the gui
+
+    python seed.py --bbox 37.5,12.4,38.3,15.7 --zoom 10-14
+    python seed.py --kml kml/sicilia.kml --zoom 8-12 --map-type 3
+    python seed.py --kml kml/sicilia.kml --zoom 12-17 --corridor 500m
+"""
+
+import os
+import sys
+import math
+import time
+import Queue
+import random
+import logging
+import threading
+from optparse import OptionParser
+
+import downloader
+import geometry
+import kmlparser
+import tilestore
+from projection import mercator
+
+SEED_THREADS = 8
+SEED_RETRIES = 3  # tentativi per ogni tile prima di rinunciare
+REPORT_INTERVAL = 2  # secondi tra un resoconto e l'altro
+
+
+def tile_coords(lat, lon, zoom):
+    """
+    Returns:
+        tuple.  (x, y) position of (lat, lon) in tile units
+    """
+    x, y = mercator.lat_lon_to_pixels(lat, lon, zoom)
+    return x / 256.0, y / 256.0
+
+
+def bbox_tiles(south, west, north, east, zoom):
+    """
+    Returns:
+        iterator.  the (x, y, zoom) tiles of a lat/lon bounding box
+    """
+    last = 2 ** zoom - 1
+    x1, y1 = tile_coords(north, west, zoom)
+    x2, y2 = tile_coords(south, east, zoom)
+    for x in range(max(int(x1), 0), min(int(x2), last) + 1):
+        for y in range(max(int(y1), 0), min(int(y2), last) + 1):
+            yield x, y, zoom
+
+
+def parse_buffer(text):
+    """
+    Returns:
+        tuple.  (distance, unit) of "500m" or "256px"
+    """
+    for unit in ("px", "m"):
+        if text.endswith(unit):
+            return float(text[:-len(unit)]), unit
+    raise ValueError("the buffer must end with px or m: %s" % text)
+
+
+def buffer_tiles(buffer, points, zoom):
+    """
+    converts a buffer distance in tile units near points; the scale of the
+    map grows with the latitude, the highest one is used so that the
+    corridor is never narrower than requested
+
+    Args:
+        buffer (tuple): (distance, unit) as returned by parse_buffer
+        points (list): (lat, lon) of the path
+    """
+    distance, unit = buffer
+    if unit == "px":
+        return distance / 256.0
+    lat = min(max(abs(lat) for lat, _ in points), 85.0)
+    resolution = mercator.Resolution(zoom) * math.cos(math.radians(lat))
+    return distance / resolution / 256.0
+
+
+def kml_tiles(placemarks, zoom, corridor=None):
+    """
+    finds the tiles of the placemarks of a kml file: the tile of each
+    point, the area of polygons and closed linestrings, the bounding box of
+    the other linestrings. With a corridor buffer, points and linestrings
+    give instead the tiles within that distance of them.
+
+    Args:
+        corridor (tuple): (distance, unit) as returned by parse_buffer
+
+    Returns:
+        iterator.  the (x, y, zoom) tiles, without duplicates
+    """
+    last = 2 ** zoom - 1
+    seen = set()
+    for kind, _, _, points in placemarks:
+        if not points:
+            continue
+        if corridor is not None and kind != "polygon":
+            path = [tile_coords(lat, lon, zoom) for lat, lon in points]
+            buffer = buffer_tiles(corridor, points, zoom)
+            cells = ((x, y, zoom) for x, y in
+                    geometry.corridor_tiles(path, buffer))
+        elif kind == "polygon" or (kind == "linestring" and
+                len(points) > 2 and points[0] == points[-1]):
+            ring = [tile_coords(lat, lon, zoom) for lat, lon in points]
+            cells = ((x, y, zoom) for x, y in geometry.polygon_tiles(ring))
+        elif kind == "point":
+            x, y = tile_coords(points[0][0], points[0][1], zoom)
+            cells = [(int(x), int(y), zoom)]
+        else:
+            lats = [lat for lat, _ in points]
+            lons = [lon for _, lon in points]
+            cells = bbox_tiles(min(lats), min(lons), max(lats), max(lons),
+                    zoom)
+        for cell in cells:
+            if 0 <= cell[0] <= last and 0 <= cell[1] <= last and \
+                    cell not in seen:
+                seen.add(cell)
+                yield cell
+
+
+class Seeder:
+    """
+    Downloads a set of tiles into a tile store with a pool of threads that
+    share keep-alive connections, at most rate tiles per second. Tiles
+    already in the store are skipped, so an interrupted seeding can simply
+    be started again.
+    """
+
+    def __init__(self, store, map_type, threads=SEED_THREADS, rate=0):
+        """
+        Args:
+            store: the tile store to fill
+            map_type (int): key of downloader.baseurlmap
+            threads (int): parallel downloads
+            rate (float): max tiles per second, 0 for no limit
+        """
+        self.store = store
+        self.map_type = map_type
+        self.threads = threads
+        self.pool = downloader.ConnectionPool(maxsize=threads)
+        self.limiter = downloader.RateLimiter(rate)
+        self.jobs = Queue.Queue(maxsize=threads * 4)
+        self.total = 0
+        self.downloaded = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes = 0
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    def download(self, key):
+        x, y, zoom = key
+        url = downloader.tile_url(self.map_type, x, y, zoom)
+        for attempt in range(SEED_RETRIES):
+            self.limiter.wait()
+            try:
+                status, content_type, data = self.pool.fetch(url)
+                if status == 200:
+                    self.store.put(x, y, zoom, data, content_type)
+                    with self._lock:
+                        self.downloaded += 1
+                        self.bytes += len(data)
+                    return
+                error = "HTTP status %d" % status
+                if downloader.is_permanent(status):
+                    break
+            except IOError as e:
+                error = e
+            # attesa esponenziale con jitter prima di riprovare
+            delay = downloader.RETRY_BASE * 2 ** attempt
+            time.sleep(delay / 2.0 + random.uniform(0, delay / 2.0))
+        logging.error("tile %d-%d-%d not downloaded: %s", x, y, zoom, error)
+        with self._lock:
+            self.failed += 1
+
+    def worker(self):
+        while True:
+            key = self.jobs.get()
+            try:
+                if key is None:
+                    return
+                self.download(key)
+            finally:
+                self.jobs.task_done()
+
+    def report(self):
+        """
+        Returns:
+            str.  progress, throughput and estimated time left
+        """
+        elapsed = max(time.time() - self.start, 0.001)
+        done = self.downloaded + self.skipped + self.failed
+        speed = self.downloaded / elapsed
+        if speed > 0:
+            eta = "%ds" % ((self.total - done) / speed)
+        else:
+            eta = "?"
+        return ("%d/%d tiles (%d cached, %d failed), %.1f tiles/s, "
+                "%.0f KB/s, ETA %s" % (done, self.total, self.skipped,
+                self.failed, speed, self.bytes / elapsed / 1024, eta))
+
+    def run(self, tiles, total, out=sys.stderr):
+        """
+        downloads the tiles that are not in the store yet
+
+        Args:
+            tiles (iterator): the (x, y, zoom) tiles to seed
+            total (int): how many tiles there are, for the report
+            out (file): where the progress is written
+        """
+        self.total = total
+        self.start = time.time()
+        workers = []
+        for i in range(self.threads):
+            t = threading.Thread(target=self.worker, name="seed%d" % i)
+            t.daemon = True
+            t.start()
+            workers.append(t)
+        reported = time.time()
+        for x, y, zoom in tiles:
+            if self.store.has(x, y, zoom):
+                self.skipped += 1
+            else:
+                self.jobs.put((x, y, zoom))
+            if time.time() - reported >= REPORT_INTERVAL:
+                out.write("\r" + self.report())
+                reported = time.time()
+        for t in workers:
+            self.jobs.put(None)
+        while any(t.is_alive() for t in workers):
+            for t in workers:
+                t.join(REPORT_INTERVAL)
+            out.write("\r" + self.report())
+        self.store.flush()
+        self.pool.close()
+        out.write("\r" + self.report() + "\n")
+
+
+def parse_zoom(text):
+    """
+    Returns:
+        list.  the zoom levels of "12" or "10-14"
+    """
+    first, _, last = text.partition("-")
+    return range(int(first), int(last or first) + 1)
+
+
+def main():
+    parser = OptionParser(usage="%prog (--bbox S,W,N,E | --kml FILE) "
+            "--zoom MIN-MAX [options]")
+    parser.add_option("--bbox", help="south,west,north,east in degrees")
+    parser.add_option("--kml", help="kml file with the region to seed")
+    parser.add_option("--corridor", metavar="BUFFER",
+            help="with --kml, seed only the tiles within BUFFER (e.g. 500m "
+            "or 256px) of points and linestrings")
+    parser.add_option("--zoom", default="0-10",
+            help="zoom level or range, e.g. 12 or 10-14 [%default]")
+    parser.add_option("--map-type", type="int", default=0,
+            help="map type, see downloader.baseurlmap [%default]")
+    parser.add_option("--cache",
+            help="tile store: a directory or a .mbtiles file "
+            "[cache/MAP_TYPE/]")
+    parser.add_option("--threads", type="int", default=SEED_THREADS,
+            help="parallel downloads [%default]")
+    parser.add_option("--rate", type="float", default=0,
+            help="max tiles per second, 0 for no limit [%default]")
+    parser.add_option("--dry-run", action="store_true", default=False,
+            help="only count the tiles")
+    options, args = parser.parse_args()
+    logging.basicConfig(format='%(levelname)s: %(message)s')
+    if bool(options.bbox) == bool(options.kml):
+        parser.error("one of --bbox and --kml is needed")
+    if options.map_type not in downloader.baseurlmap:
+        parser.error("unknown map type %d" % options.map_type)
+    corridor = None
+    if options.corridor:
+        if not options.kml:
+            parser.error("--corridor needs --kml")
+        try:
+            corridor = parse_buffer(options.corridor)
+        except ValueError as e:
+            parser.error(str(e))
+    zooms = parse_zoom(options.zoom)
+
+    if options.bbox:
+        south, west, north, east = [float(v) for v in
+                options.bbox.split(",")]
+
+        def tiles():
+            for zoom in zooms:
+                for tile in bbox_tiles(south, west, north, east, zoom):
+                    yield tile
+    else:
+        placemarks = kmlparser.parse_kml(options.kml)
+
+        def tiles():
+            for zoom in zooms:
+                for tile in kml_tiles(placemarks, zoom, corridor):
+                    yield tile
+
+    total = sum(1 for _ in tiles())
+    sys.stderr.write("%d tiles in zoom levels %d-%d\n" % (total, zooms[0],
+            zooms[-1]))
+    if options.dry_run:
+        return
+
+    cache = options.cache or os.path.join(os.getcwd(), "cache",
+            str(options.map_type))
+    store = tilestore.open_store(cache)
+    seeder = Seeder(store, options.map_type, options.threads, options.rate)
+    try:
+        seeder.run(tiles(), total)
+    except KeyboardInterrupt:
+        sys.stderr.write("\ninterrupted, run again to resume\n")
+    finally:
+        store.close()
+    if seeder.failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1007 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    This file is part of wxpymaps.
+#
+#    wxpymaps is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    wxpymaps is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with wxpymaps.  If not, see <http://www.gnu.org/licenses/>.
+
+"""offline storage of the downloaded tiles, does not need wx"""
+
+import os
+import sys
+import time
+import logging
+import sqlite3
+import tempfile
+import threading
+from optparse import OptionParser
+
+PNG_SIGNATURE = "\x89PNG\r\n\x1a\n"
+PNG_END = "IEND\xaeB`\x82"
+JPEG_SIGNATURE = "\xff\xd8\xff"
+JPEG_END = "\xff\xd9"
+FILE_LAYOUT = "zxy"  # "zxy" (zoom/x/y.png) oppure "flat" (x-y-zoom.png)
+MBTILES_BATCH = 100  # tile scritte in una sola transazione
+MBTILES_FLUSH = 2  # secondi massimi prima di scrivere le tile in attesa
+INDEX_FLUSH = 5  # secondi massimi prima di scrivere gli accessi nell'indice
+INDEX_SUFFIX = ".index"  # indice delle dimensioni, accanto allo store
+QUOTA_LOW_WATER = 0.9  # oltre la quota si libera fino a questa frazione
+EXPIRE_INTERVAL = 3600  # secondi tra due controlli delle tile scadute
+
+# mkstemp crea file leggibili solo dal proprietario, le tile invece devono
+# avere i permessi di un file normale
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def check_tile(data, content_type=""):
+    """
+    checks that data is a whole png or jpeg image (the satellite maps are
+    jpeg), so that truncated downloads and error pages are not cached
+
+    Raises:
+        IOError: if data is not a valid tile
+    """
+    if content_type and not content_type.startswith("image/"):
+        raise IOError("not an image: %s" % content_type)
+    if data.startswith(PNG_SIGNATURE):
+        if not data.endswith(PNG_END):
+            raise IOError("truncated png (%d bytes)" % len(data))
+    elif data.startswith(JPEG_SIGNATURE):
+        # alcuni encoder aggiungono byte dopo la fine dell'immagine
+        if JPEG_END not in data[-64:]:
+            raise IOError("truncated jpeg (%d bytes)" % len(data))
+    elif not data.startswith(("GIF87a", "GIF89a")):
+        raise IOError("unknown image format (%d bytes)" % len(data))
+
+
+def tile_format(data):
+    """
+    Returns:
+        str.  the mbtiles format of the image data, "png" or "jpg", None
+        for other formats
+    """
+    if data.startswith(PNG_SIGNATURE):
+        return "png"
+    if data.startswith(JPEG_SIGNATURE):
+        return "jpg"
+    return None
+
+
+def write_tile(filename, data, content_type=""):
+    """
+    checks a tile and writes it atomically: the data goes into a temporary
+    file in the same directory, which is then renamed to filename, so that
+    readers never see a partial tile
+
+    Raises:
+        IOError: if the tile is not valid or can not be written
+    """
+    check_tile(data, content_type)
+    directory = os.path.dirname(filename)
+    try:
+        fd, tmpname = tempfile.mkstemp(suffix=".tmp", dir=directory)
+    except OSError as e:
+        raise IOError(e)
+    try:
+        fp = os.fdopen(fd, "wb")
+        try:
+            fp.write(data)
+        finally:
+            fp.close()
+        os.chmod(tmpname, 0666 & ~_umask)
+        try:
+            os.rename(tmpname, filename)
+        except OSError:
+            # su windows rename non sovrascrive un file esistente
+            if os.name != "nt" or not os.path.exists(filename):
+                raise
+            os.remove(filename)
+            os.rename(tmpname, filename)
+    except (IOError, OSError) as e:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise IOError(e)
+
+
+def tile_key(name):
+    """
+    parses the name of a cached tile file, x-y-zoom.png
+
+    Returns:
+        tuple.  (x, y, zoom), or None if name is not a tile
+    """
+    base, ext = os.path.splitext(name)
+    parts = base.split("-")
+    if ext != ".png" or len(parts) != 3:
+        return None
+    try:
+        return tuple(int(p) for p in parts)
+    except ValueError:
+        return None
+
+
+class FileTileStore:
+    """
+    Tiles stored one per file in a directory, as zoom/x/y.png ("zxy"
+    layout) or as x-y-zoom.png ("flat" layout, used by older versions).
+    With the zxy layout, a tile still stored flat is moved to its new
+    place the first time it is read.
+    """
+
+    def __init__(self, directory, layout=FILE_LAYOUT):
+        self.directory = directory
+        self.layout = layout
+        self._dirs = set()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def filename(self, x, y, zoom, layout=None):
+        if (layout or self.layout) == "flat":
+            return os.path.join(self.directory,
+                    str(x) + "-" + str(y) + "-" + str(zoom) + ".png")
+        return os.path.join(self.directory, str(zoom), str(x), str(y) + ".png")
+
+    def _makedirs(self, filename):
+        directory = os.path.dirname(filename)
+        if directory not in self._dirs:
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # creata nel frattempo da un altro thread
+                    if not os.path.isdir(directory):
+                        raise
+            self._dirs.add(directory)
+
+    def migrate(self, x, y, zoom):
+        """
+        moves a tile stored with the flat layout to its zxy place
+
+        Returns:
+            bool.  True if the tile has been moved
+        """
+        if self.layout == "flat":
+            return False
+        old = self.filename(x, y, zoom, "flat")
+        if not os.path.exists(old):
+            return False
+        new = self.filename(x, y, zoom)
+        try:
+            self._makedirs(new)
+            os.rename(old, new)
+        except OSError as e:
+            logging.error("can't move %s: %s", old, e)
+            return False
+        return True
+
+    def has(self, x, y, zoom):
+        return (os.path.exists(self.filename(x, y, zoom)) or
+                self.migrate(x, y, zoom))
+
+    def get(self, x, y, zoom):
+        """
+        Returns:
+            str.  the image data, or None if the tile is not stored
+        """
+        try:
+            fp = open(self.filename(x, y, zoom), "rb")
+        except IOError:
+            if not self.migrate(x, y, zoom):
+                return None
+            return self.get(x, y, zoom)
+        try:
+            return fp.read()
+        finally:
+            fp.close()
+
+    def put(self, x, y, zoom, data, content_type=""):
+        """
+        Raises:
+            IOError: if the tile is not valid or can not be written
+        """
+        filename = self.filename(x, y, zoom)
+        try:
+            self._makedirs(filename)
+        except OSError as e:
+            raise IOError(e)
+        write_tile(filename, data, content_type)
+
+    def size(self, x, y, zoom):
+        """
+        Returns:
+            int.  bytes used by the tile, 0 if it is not stored
+        """
+        for layout in (self.layout, "flat"):
+            try:
+                return os.path.getsize(self.filename(x, y, zoom, layout))
+            except OSError:
+                pass
+        return 0
+
+    def delete(self, x, y, zoom):
+        for layout in ("zxy", "flat"):
+            try:
+                os.remove(self.filename(x, y, zoom, layout))
+            except OSError:
+                pass
+
+    def delete_many(self, keys):
+        """
+        Args:
+            keys (list): (x, y, zoom) of the tiles to delete
+        """
+        for x, y, zoom in keys:
+            self.delete(x, y, zoom)
+
+    def keys(self):
+        """
+        Returns:
+            iterator.  the (x, y, zoom) of the stored tiles, in both layouts
+        """
+        for name in os.listdir(self.directory):
+            key = tile_key(name)
+            if key is not None:
+                yield key
+            elif name.isdigit():
+                zoom = int(name)
+                zoomdir = os.path.join(self.directory, name)
+                for xname in os.listdir(zoomdir):
+                    if not xname.isdigit():
+                        continue
+                    for yname in os.listdir(os.path.join(zoomdir, xname)):
+                        ybase, ext = os.path.splitext(yname)
+                        if ext == ".png" and ybase.isdigit():
+                            yield int(xname), int(ybase), zoom
+
+    def touch(self, x, y, zoom):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class MBTilesStore:
+    """
+    Tiles stored in a single MBTiles (sqlite) file. Writes are buffered and
+    committed MBTILES_BATCH at a time, or at least every MBTILES_FLUSH
+    seconds; buffered tiles are already visible to get and has. The format
+    in the metadata is taken from the tiles stored, png for the road maps
+    and jpg for the satellite ones.
+    """
+
+    def __init__(self, path, name="wxpymaps", batch=MBTILES_BATCH,
+            flushtime=MBTILES_FLUSH):
+        """
+        Args:
+            path (str): the .mbtiles file, created if missing
+            name (str): name written in the metadata of a new file
+            batch (int): tiles written in a single transaction
+            flushtime (float): max seconds a tile stays in the buffer
+        """
+        self.path = path
+        self.batch = batch
+        self.flushtime = flushtime
+        self._lock = threading.RLock()
+        self._pending = {}
+        self._lastflush = time.time()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.text_factory = str
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS metadata "
+                    "(name TEXT, value TEXT)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS tiles "
+                    "(zoom_level INTEGER, tile_column INTEGER, "
+                    "tile_row INTEGER, tile_data BLOB)")
+            self._db.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index "
+                    "ON tiles (zoom_level, tile_column, tile_row)")
+            if not self._db.execute("SELECT 1 FROM metadata").fetchone():
+                self._db.executemany("INSERT INTO metadata VALUES (?, ?)",
+                        [("name", name), ("type", "baselayer"),
+                        ("version", "1"),
+                        ("description", "wxpymaps offline cache")])
+        row = self._db.execute("SELECT value FROM metadata WHERE "
+                "name='format'").fetchone()
+        self.format = row[0] if row else None
+
+    def _setformat(self, data):
+        # scrive il formato alla prima tile, o lo corregge nei file
+        # creati dalle versioni che scrivevano sempre png
+        format = tile_format(data)
+        if format is None:
+            return
+        with self._db:
+            self._db.execute("DELETE FROM metadata WHERE name='format'")
+            self._db.execute("INSERT INTO metadata VALUES ('format', ?)",
+                    (format,))
+        self.format = format
+
+    @staticmethod
+    def _row(y, zoom):
+        # mbtiles numera le righe dal basso (schema tms)
+        return (2 ** zoom) - 1 - y
+
+    def has(self, x, y, zoom):
+        with self._lock:
+            if (x, y, zoom) in self._pending:
+                return True
+            return self._db.execute("SELECT 1 FROM tiles WHERE zoom_level=? "
+                    "AND tile_column=? AND tile_row=?",
+                    (zoom, x, self._row(y, zoom))).fetchone() is not None
+
+    def get(self, x, y, zoom):
+        """
+        Returns:
+            str.  the image data, or None if the tile is not stored
+        """
+        with self._lock:
+            data = self._pending.get((x, y, zoom))
+            if data is not None:
+                return data
+            row = self._db.execute("SELECT tile_data FROM tiles WHERE "
+                    "zoom_level=? AND tile_column=? AND tile_row=?",
+                    (zoom, x, self._row(y, zoom))).fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def put(self, x, y, zoom, data, content_type=""):
+        """
+        Raises:
+            IOError: if the tile is not valid or can not be written
+        """
+        check_tile(data, content_type)
+        with self._lock:
+            if tile_format(data) != self.format:
+                self._setformat(data)
+            self._pending[(x, y, zoom)] = data
+            if (len(self._pending) >= self.batch or
+                    time.time() - self._lastflush >= self.flushtime):
+                self.flush()
+
+    def size(self, x, y, zoom):
+        """
+        Returns:
+            int.  bytes used by the tile, 0 if it is not stored
+        """
+        with self._lock:
+            data = self._pending.get((x, y, zoom))
+            if data is not None:
+                return len(data)
+            row = self._db.execute("SELECT length(tile_data) FROM tiles "
+                    "WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                    (zoom, x, self._row(y, zoom))).fetchone()
+        return row[0] if row else 0
+
+    def delete(self, x, y, zoom):
+        with self._lock:
+            self._pending.pop((x, y, zoom), None)
+            with self._db:
+                self._db.execute("DELETE FROM tiles WHERE zoom_level=? AND "
+                        "tile_column=? AND tile_row=?",
+                        (zoom, x, self._row(y, zoom)))
+
+    def delete_many(self, keys):
+        """
+        deletes many tiles in a single transaction
+
+        Args:
+            keys (list): (x, y, zoom) of the tiles to delete
+        """
+        with self._lock:
+            for key in keys:
+                self._pending.pop(key, None)
+            with self._db:
+                self._db.executemany("DELETE FROM tiles WHERE zoom_level=? "
+                        "AND tile_column=? AND tile_row=?",
+                        [(zoom, x, self._row(y, zoom))
+                        for x, y, zoom in keys])
+
+    def keys(self):
+        """
+        Returns:
+            iterator.  the (x, y, zoom) of the stored tiles
+        """
+        self.flush()
+        with self._lock:
+            rows = self._db.execute("SELECT tile_column, tile_row, "
+                    "zoom_level FROM tiles").fetchall()
+        for x, row, zoom in rows:
+            yield x, self._row(row, zoom), zoom
+
+    def touch(self, x, y, zoom):
+        pass
+
+    def flush(self):
+        """
+        writes the buffered tiles in a single transaction
+        """
+        with self._lock:
+            self._lastflush = time.time()
+            if not self._pending:
+                return
+            rows = [(zoom, x, self._row(y, zoom), sqlite3.Binary(data))
+                    for (x, y, zoom), data in self._pending.iteritems()]
+            try:
+                with self._db:
+                    self._db.executemany("INSERT OR REPLACE INTO tiles "
+                            "VALUES (?, ?, ?, ?)", rows)
+            except sqlite3.Error as e:
+                raise IOError(e)
+            self._pending.clear()
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self._db.close()
+
+
+class ManagedTileStore:
+    """
+    Wraps a tile store keeping, in a small sqlite index next to it, the size,
+    download time and last access of every tile, so that the size of the
+    cache is known without scanning it. Keeps the cache under quota bytes by
+    removing the least recently used tiles, and removes the tiles downloaded
+    more than max_age seconds ago. The index is built with a single scan of
+    the store the first time, then kept up to date by put and delete; the
+    accesses are written in batches, at least every INDEX_FLUSH seconds.
+    The scan can run in a thread: the store can be used meanwhile, but
+    nothing is evicted or expired until it ends. The tiles to remove are
+    chosen holding the lock, their files are deleted after releasing it, so
+    get and put do not wait for a long eviction.
+    """
+
+    def __init__(self, store, path, quota=0, max_age=0, background=False,
+            group=None):
+        """
+        Args:
+            store: the tile store to manage
+            path (str): the index file, created (scanning store) if missing
+            quota (int): max bytes of the cache, 0 for no limit
+            max_age (float): max seconds a tile is kept, 0 for no limit
+            background (bool): scan the store in a thread instead of
+                waiting for the scan
+            group (QuotaGroup): a quota shared with other stores, used
+                instead of quota
+        """
+        self.store = store
+        self.path = path
+        self.quota = quota
+        self.group = group
+        if group is not None:
+            group.add(self)
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+        self._added = {}  # (x, y, zoom) -> (size, mtime) non ancora scritti
+        self._touched = {}  # (x, y, zoom) -> atime non ancora scritti
+        self._lastflush = time.time()
+        self._lastexpire = 0
+        self.ready = True
+        new = not os.path.exists(path)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS tiles "
+                    "(zoom INTEGER, x INTEGER, y INTEGER, size INTEGER, "
+                    "mtime REAL, atime REAL, PRIMARY KEY (zoom, x, y))")
+            self._db.execute("CREATE INDEX IF NOT EXISTS tile_atime "
+                    "ON tiles (atime)")
+        self.bytes = 0
+        if not new:
+            self._count()
+        if background:
+            self.ready = not new
+            t = threading.Thread(target=self._index, args=(new,),
+                    name="index " + os.path.basename(path))
+            t.daemon = True
+            t.start()
+        else:
+            self.maintain(new)
+
+    def _index(self, new):
+        try:
+            self.maintain(new)
+        except Exception:
+            logging.exception("indexing %s failed", self.path)
+
+    def maintain(self, rebuild=False):
+        """
+        builds the index if rebuild, then applies quota and max age
+        """
+        if rebuild:
+            self.rebuild()
+        self.expire()
+        self.evict()
+
+    def _count(self):
+        self.bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) "
+                "FROM tiles").fetchone()[0]
+
+    def rebuild(self):
+        """
+        adds to the index the tiles of the store it does not list yet,
+        scanning the whole store; the tiles found are considered downloaded
+        and used now, those written during the scan keep their entry
+        """
+        logging.info("indexing the tiles of %s", self.path)
+        now = time.time()
+        rows = [(zoom, x, y, self.store.size(x, y, zoom), now, now)
+                for x, y, zoom in self.store.keys()]
+        with self._lock:
+            self._write()
+            with self._db:
+                self._db.executemany("INSERT OR IGNORE INTO tiles "
+                        "VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._count()
+            self.ready = True
+        logging.info("%d tiles indexed in %s", len(rows), self.path)
+
+    def _size(self, key):
+        # dimensione con cui la tile e' contata in self.bytes
+        if key in self._added:
+            return self._added[key][0]
+        x, y, zoom = key
+        row = self._db.execute("SELECT size FROM tiles WHERE zoom=? AND "
+                "x=? AND y=?", (zoom, x, y)).fetchone()
+        return row[0] if row else 0
+
+    def has(self, x, y, zoom):
+        return self.store.has(x, y, zoom)
+
+    def get(self, x, y, zoom):
+        """
+        Returns:
+            str.  the image data, or None if the tile is not stored
+        """
+        data = self.store.get(x, y, zoom)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._touched[(x, y, zoom)] = time.time()
+                self._autoflush()
+        return data
+
+    def touch(self, x, y, zoom):
+        """
+        records an access to a tile that was not read from the store, e.g.
+        one drawn from the decoded bitmaps in memory, so that the tiles in
+        use are not evicted
+        """
+        with self._lock:
+            self._touched[(x, y, zoom)] = time.time()
+            self._autoflush()
+
+    def put(self, x, y, zoom, data, content_type=""):
+        """
+        Raises:
+            IOError: if the tile is not valid or can not be written
+        """
+        self.store.put(x, y, zoom, data, content_type)
+        key = (x, y, zoom)
+        with self._lock:
+            self.bytes += len(data) - self._size(key)
+            self._added[key] = (len(data), time.time())
+            self._touched.pop(key, None)
+            full = self.ready and self.over()
+            if not full:
+                self._autoflush()
+        if full:
+            self.evict()
+
+    def size(self, x, y, zoom):
+        return self.store.size(x, y, zoom)
+
+    def delete(self, x, y, zoom):
+        self.store.delete(x, y, zoom)
+        key = (x, y, zoom)
+        with self._lock:
+            self.bytes -= self._size(key)
+            self._added.pop(key, None)
+            self._touched.pop(key, None)
+            with self._db:
+                self._db.execute("DELETE FROM tiles WHERE zoom=? AND x=? AND "
+                        "y=?", (zoom, x, y))
+
+    def delete_many(self, keys):
+        for x, y, zoom in keys:
+            self.delete(x, y, zoom)
+
+    def keys(self):
+        return self.store.keys()
+
+    def _unindex(self, rows):
+        # toglie dall'indice le tile (zoom, x, y, size), con il lock preso;
+        # i file li cancella poi _purge
+        self.bytes -= sum(row[3] for row in rows)
+        self.evictions += len(rows)
+        with self._db:
+            self._db.executemany("DELETE FROM tiles WHERE zoom=? AND x=? AND "
+                    "y=?", [row[:3] for row in rows])
+
+    def _purge(self, rows):
+        # cancella i file senza il lock: se nel frattempo una tile e' stata
+        # scaricata di nuovo si perde, e verra' riscaricata
+        self.store.delete_many([(x, y, zoom) for zoom, x, y, _ in rows])
+
+    def over(self):
+        """
+        Returns:
+            bool.  True if the cache, or the group of caches it belongs
+            to, is over its quota
+        """
+        if self.group is not None:
+            return self.group.over()
+        return bool(self.quota) and self.bytes > self.quota
+
+    def oldest(self, size):
+        """
+        Returns:
+            list.  (atime, (zoom, x, y, size)) of the least recently used
+            tiles, the fewest whose sizes add up to size
+        """
+        rows = []
+        with self._lock:
+            self._write()
+            for row in self._db.execute("SELECT atime, zoom, x, y, size "
+                    "FROM tiles ORDER BY atime"):
+                if size <= 0:
+                    break
+                rows.append((row[0], row[1:]))
+                size -= row[4]
+        return rows
+
+    def remove(self, rows):
+        """
+        removes from the index, then from the store, the tiles (zoom, x, y,
+        size) chosen by oldest
+        """
+        with self._lock:
+            self._unindex(rows)
+        self._purge(rows)
+
+    def evict(self):
+        """
+        removes the least recently used tiles until the cache is back under
+        QUOTA_LOW_WATER of the quota; with a group, removes those of all
+        the caches of the group
+
+        Returns:
+            int.  number of tiles removed
+        """
+        if self.group is not None:
+            return self.group.evict()
+        if not self.ready or not self.over():
+            return 0
+        # solo quelle che servono per scendere sotto QUOTA_LOW_WATER
+        rows = [row for _, row in self.oldest(self.bytes -
+                self.quota * QUOTA_LOW_WATER)]
+        self.remove(rows)
+        logging.info("%d tiles evicted from %s, %d bytes left", len(rows),
+                self.path, self.bytes)
+        return len(rows)
+
+    def expire(self):
+        """
+        removes the tiles downloaded more than max_age seconds ago
+
+        Returns:
+            int.  number of tiles removed
+        """
+        if not self.max_age or not self.ready:
+            return 0
+        with self._lock:
+            self._lastexpire = time.time()
+            self._write()
+            rows = self._db.execute("SELECT zoom, x, y, size FROM tiles "
+                    "WHERE mtime < ?",
+                    (time.time() - self.max_age,)).fetchall()
+            self._unindex(rows)
+        self._purge(rows)
+        if rows:
+            logging.info("%d expired tiles removed from %s", len(rows),
+                    self.path)
+        return len(rows)
+
+    def _write(self):
+        # scrive nell'indice le tile nuove e gli accessi in attesa
+        self._lastflush = time.time()
+        if not self._added and not self._touched:
+            return
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO tiles "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(zoom, x, y, size, mtime, mtime) for (x, y, zoom),
+                    (size, mtime) in self._added.iteritems()])
+            self._db.executemany("UPDATE tiles SET atime=? WHERE zoom=? AND "
+                    "x=? AND y=?", [(atime, zoom, x, y) for (x, y, zoom),
+                    atime in self._touched.iteritems()])
+        self._added.clear()
+        self._touched.clear()
+
+    def _autoflush(self):
+        # chiamata da get e put, anche dalla gui: le tile scadute si
+        # cercano in un thread una volta ogni EXPIRE_INTERVAL secondi
+        now = time.time()
+        if now - self._lastflush >= INDEX_FLUSH:
+            self.flush()
+        if (self.max_age and self.ready and
+                now - self._lastexpire >= EXPIRE_INTERVAL):
+            self._lastexpire = now
+            t = threading.Thread(target=self._expire,
+                    name="expire " + os.path.basename(self.path))
+            t.daemon = True
+            t.start()
+
+    def _expire(self):
+        try:
+            self.expire()
+        except sqlite3.Error:
+            logging.exception("expiring the tiles of %s failed", self.path)
+
+    def flush(self):
+        """
+        writes the index and the store
+        """
+        with self._lock:
+            self.store.flush()
+            try:
+                self._write()
+            except sqlite3.Error as e:
+                raise IOError(e)
+
+    def usage(self):
+        """
+        Returns:
+            list.  (zoom, tiles, bytes) for each zoom level in the cache
+        """
+        with self._lock:
+            self._write()
+            return self._db.execute("SELECT zoom, COUNT(*), SUM(size) FROM "
+                    "tiles GROUP BY zoom ORDER BY zoom").fetchall()
+
+    def stats(self):
+        """
+        Returns:
+            dict.  hits, misses, evictions, bytes and quota of the cache
+        """
+        quota = self.quota
+        if self.group is not None:
+            quota = self.group.quota
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "bytes": self.bytes,
+                "quota": quota}
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self._db.close()
+            self.store.close()
+
+
+class QuotaGroup:
+    """
+    A quota shared by several ManagedTileStores, e.g. the caches of the
+    map types of the application: when their total size goes over quota,
+    the least recently used tiles of all of them are removed. The stores
+    still indexing are left out until they are ready.
+    """
+
+    def __init__(self, quota):
+        """
+        Args:
+            quota (int): max bytes of all the stores together
+        """
+        self.quota = quota
+        self.stores = []
+        self._lock = threading.Lock()  # una sola eliminazione alla volta
+
+    def add(self, store):
+        self.stores.append(store)
+
+    def size(self):
+        """
+        Returns:
+            int.  bytes of the stores of the group
+        """
+        return sum(store.bytes for store in self.stores)
+
+    def over(self):
+        return bool(self.quota) and self.size() > self.quota
+
+    def evict(self):
+        """
+        removes the least recently used tiles of all the stores until they
+        are back under QUOTA_LOW_WATER of the quota
+
+        Returns:
+            int.  number of tiles removed
+        """
+        with self._lock:
+            if not self.over():
+                return 0
+            excess = self.size() - self.quota * QUOTA_LOW_WATER
+            # nessuna cache da' piu' di excess byte: prendo da ognuna le
+            # tile piu' vecchie fino a excess e poi scelgo tra tutte
+            rows = []
+            for store in self.stores:
+                if store.ready:
+                    rows.extend((atime, row, store) for atime, row in
+                            store.oldest(excess))
+            rows.sort(key=lambda item: item[0])
+            chosen = {}
+            for _, row, store in rows:
+                if excess <= 0:
+                    break
+                chosen.setdefault(store, []).append(row)
+                excess -= row[3]
+            for store, victims in chosen.iteritems():
+                store.remove(victims)
+        removed = sum(len(victims) for victims in chosen.itervalues())
+        logging.info("%d tiles evicted from %d caches, %d bytes left",
+                removed, len(chosen), self.size())
+        return removed
+
+
+def index_path(path):
+    """
+    Returns:
+        str.  the index file of the store at path, e.g. cache/0.index
+    """
+    return path.rstrip("/" + os.sep) + INDEX_SUFFIX
+
+
+def open_store(path, index=None, quota=0, max_age=0, background=False,
+        group=None):
+    """
+    opens the tile store at path: a .mbtiles file, or a directory of
+    zoom/x/y.png files. The store is wrapped in a ManagedTileStore if index
+    is True, if a quota, a max age or a QuotaGroup are given, or if index is
+    None and the store already has an index, so that tools that fill the
+    cache keep the index of the application up to date. With background, a
+    new index is built in a thread.
+    """
+    if path.endswith(".mbtiles"):
+        store = MBTilesStore(path)
+    else:
+        store = FileTileStore(path)
+    if index is None:
+        index = (quota or max_age or group is not None or
+                os.path.exists(index_path(path)))
+    if index:
+        return ManagedTileStore(store, index_path(path), quota, max_age,
+                background, group)
+    return store
+
+
+def copy_tiles(src, dst, progress=None):
+    """
+    copies the tiles missing in dst from src; since tiles already copied
+    are skipped, an interrupted copy can simply be started again
+
+    Args:
+        src: store to read
+        dst: store to write
+        progress (function): called as progress(copied, skipped) every
+            thousand tiles
+
+    Returns:
+        tuple.  (copied, skipped)
+    """
+    copied = skipped = 0
+    for x, y, zoom in src.keys():
+        if dst.has(x, y, zoom):
+            skipped += 1
+        else:
+            data = src.get(x, y, zoom)
+            try:
+                if data is None:
+                    raise IOError("tile disappeared")
+                dst.put(x, y, zoom, data)
+                copied += 1
+            except IOError as e:
+                logging.error("tile %d-%d-%d not copied: %s", x, y, zoom, e)
+                skipped += 1
+        if progress is not None and (copied + skipped) % 1000 == 0:
+            progress(copied, skipped)
+    dst.flush()
+    return copied, skipped
+
+
+def migrate(directory, progress=None):
+    """
+    moves all the tiles of a cache directory from the flat layout to the
+    zxy one; an interrupted migration can simply be started again
+
+    Args:
+        directory (str): the cache directory
+        progress (function): called as progress(moved) every thousand tiles
+
+    Returns:
+        int.  number of tiles moved
+    """
+    store = FileTileStore(directory, "zxy")
+    moved = 0
+    for name in os.listdir(directory):
+        key = tile_key(name)
+        if key is not None and store.migrate(*key):
+            moved += 1
+            if progress is not None and moved % 1000 == 0:
+                progress(moved)
+    return moved
+
+
+def main():
+    parser = OptionParser(usage="%prog SRC DST\n"
+            "       %prog --migrate DIR\n"
+            "       %prog --usage STORE\n\n"
+            "copies the tiles of the store SRC into the store DST; a store "
+            "is a .mbtiles file or a cache directory, e.g.\n"
+            "  %prog cache/0 cache/0.mbtiles    (import)\n"
+            "  %prog cache/0.mbtiles cache/0    (export)\n"
+            "with --migrate, moves the x-y-zoom.png files of the cache "
+            "directory DIR to the zoom/x/y.png layout; with --usage, shows "
+            "the tiles and bytes of STORE for each zoom level")
+    parser.add_option("--migrate", action="store_true", default=False,
+            help="migrate a cache directory to the zoom/x/y.png layout")
+    parser.add_option("--usage", action="store_true", default=False,
+            help="show the size of a store, indexing it if needed")
+    options, args = parser.parse_args()
+    if options.usage:
+        if len(args) != 1:
+            parser.error("STORE is needed")
+        store = open_store(args[0], index=True)
+        total = [0, 0]
+        for zoom, tiles, size in store.usage():
+            print "zoom %2d: %8d tiles %10.1f MB" % (zoom, tiles,
+                    size / 1048576.0)
+            total[0] += tiles
+            total[1] += size
+        print "total:   %8d tiles %10.1f MB" % (total[0],
+                total[1] / 1048576.0)
+        store.close()
+        return
+    if options.migrate:
+        if len(args) != 1:
+            parser.error("DIR is needed")
+
+        def progress(moved):
+            sys.stderr.write("\r%d moved" % moved)
+
+        moved = migrate(args[0], progress)
+        sys.stderr.write("\r%d moved\n" % moved)
+        return
+    if len(args) != 2:
+        parser.error("SRC and DST are needed")
+    src, dst = open_store(args[0]), open_store(args[1])
+
+    def progress(copied, skipped):
+        sys.stderr.write("\r%d copied, %d skipped" % (copied, skipped))
+
+    copied, skipped = copy_tiles(src, dst, progress)
+    dst.close()
+    src.close()
+    sys.stderr.write("\r%d copied, %d skipped\n" % (copied, skipped))
+
+if __name__ == '__main__':
+    main()